@@ -55,8 +55,27 @@ class PhorpSource(silo.Stream):
         return
 
     def update(self):
+        self.start()
+        time.sleep(self.conversion_time)
+        self.finish()
+
+        return
+
+    @property
+    def device(self):
+        ''' the four channels of a board share one adc'''
+        return self.board_index
+
+    @property
+    def conversion_time(self):
+        return self.channel.conversion_time
+
+    def start(self):
         self.channel.start_conversion()
-        time.sleep(self.channel.conversion_time)
+
+        return
+
+    def finish(self):
         self._raw_value = self.channel.get_conversion_volts()
         
         self.measured_quantity.value = self._raw_value
@@ -261,14 +280,16 @@ if __name__ == '__main__':
             project = silo.Deploy()
             project.load()
             project.connect(streams)
+
+            deployed = [sensor for sensor in project.sensors.values() if sensor.is_deployed]
+            sampler = silo.Sampler(deployed)
             while True:
-                for sensor in project.sensors.values():
-                    if sensor.is_deployed:
-                        sensor.update()
-                        val = round(sensor.scaled_value, 1)
-                        parm = '{} {} {}, '.format(sensor.name, val, sensor.scaled_units)
-                        print(parm, end='')
-                        # sys.stdout.flush()
+                sampler.sweep()
+                for sensor in deployed:
+                    val = round(sensor.scaled_value, 1)
+                    parm = '{} {} {}, '.format(sensor.name, val, sensor.scaled_units)
+                    print(parm, end='')
+                    # sys.stdout.flush()
 
                 print('')
                 time.sleep(project.sample_period)
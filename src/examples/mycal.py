@@ -56,8 +56,27 @@ class PhorpSource(silo.Stream):
         return
 
     def update(self):
+        self.start()
+        time.sleep(self.conversion_time)
+        self.finish()
+
+        return
+
+    @property
+    def device(self):
+        ''' the four channels of a board share one adc'''
+        return self.board_index
+
+    @property
+    def conversion_time(self):
+        return self.channel.conversion_time
+
+    def start(self):
         self.channel.start_conversion()
-        time.sleep(self.channel.conversion_time)
+
+        return
+
+    def finish(self):
         self._raw_value = self.channel.get_conversion_volts()
         
         self.measured_quantity.value = self._raw_value
@@ -342,7 +361,7 @@ if __name__ == '__main__':
 
                 components.update()
                 
-                if last_update + project.stream_period > timestamp:
+                if timestamp >= last_update + project.stream_period:
                     feed.put(components)
                     last_update = timestamp
                 
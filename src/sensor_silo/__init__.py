@@ -1,7 +1,15 @@
 from .silo import Shell
 from .silo import Deploy
+from .silo import Sink
+from .silo import MemorySink
+from .silo import JsonlSink
+from .silo import QueuedSink
 
 from .sensor import Stream
+from .sensor import Sampler
+from .sensor import AsyncStream
+from .sensor import ExecutorStream
+from .sensor import gather
 
 from .setpoint import ConstantSetpoint
 from .setpoint import StreamSetpoint
@@ -11,3 +19,11 @@ from .polynomial import PolynomialEquation
 from .polynomial import PolynomialProcedure
 from .thermistor import NtcBetaProcedure
 from .thermistor import PhorpNtcBetaProcedure
+
+from .runtime import Runtime
+from .runtime import PrintSink
+
+from .spool import Spool
+from .spool import SpoolSink
+
+from .caltable import CalibrationTable
@@ -18,9 +18,15 @@
 import datetime
 
 from . import factory
+from . import packer
 
 class Calibration():
+    # assigning any attribute written by pack() bumps revision
+    packed_attributes = frozenset(['timestamp', 'interval', 'procedure_type', 'equation', 'scaled_units', 'unit_id'])
+
     def __init__(self, package=None):
+        self.revision = 0
+
         self.timestamp = datetime.date(1970, 1, 1)
         self.interval = datetime.timedelta(days=0)
 
@@ -30,12 +36,48 @@ class Calibration():
         
         self.scaled_units = ''
         self.unit_id = ''
+
+        self._evaluator = None
+        self._compiled_equation = None
+        self._compiled_revision = None
         
         if package:
             self.unpack(package)
 
         return
 
+    @classmethod
+    def restore(cls, fields):
+        ''' returns a calibration with fields, a dict of packed attributes
+            read back from a snapshot, see Sensor.restore()'''
+        blank = cls.__dict__.get('blank')
+        if blank is None:
+            blank = cls.blank = cls().__dict__.copy()
+
+        calibration = cls.__new__(cls)
+        calibration.__dict__.update(blank)
+        calibration.__dict__.update(fields)
+        calibration.__dict__['revision'] = 0
+        calibration.__dict__['parameters'] = dict()
+
+        return calibration
+
+    def __setattr__(self, name, value):
+        if name in self.packed_attributes:
+            self.__dict__['revision'] = self.__dict__.get('revision', 0) + 1
+
+        super().__setattr__(name, value)
+
+        return
+
+    @property
+    def fingerprint(self):
+        ''' changes whenever the packed calibration would change'''
+        if self.equation is None:
+            return (self.revision, self.is_valid, None)
+
+        return (self.revision, self.is_valid, self.equation.revision)
+
     @property
     def due_date(self):
         if self.interval == 0:
@@ -58,28 +100,41 @@ class Calibration():
         print(self.pack('xyz'))
         return
     
+    def compile(self):
+        ''' returns the equations compiled evaluator, rebuilt when the equation
+            is replaced, unpacked or regenerated'''
+        equation = self.equation
+        if equation is not self._compiled_equation or equation.evaluator_revision != self._compiled_revision:
+            self._evaluator = equation.compile()
+            self._compiled_equation = equation
+            self._compiled_revision = equation.evaluator_revision
+
+        return self._evaluator
+
     # def generate(self):
     #     raise NotImplemented
     
     def pack(self, prefix):
-        package = ''
-        package += '[{}]\n'.format(prefix)
-        package += 'procedure_type = "{}"\n'.format(self.procedure_type)
-        package += 'scaled_units = "{}"\n'.format(self.scaled_units)
-        package += 'unit_id = "{}"\n'.format(self.unit_id)
-        package += 'timestamp = "{}"\n'.format(self.timestamp.isoformat())
-        package += 'interval = "{}"\n'.format(self.interval.days)
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
+        writer.write('[{}]\n'.format(prefix))
+        packer.entry(writer, 'procedure_type', self.procedure_type)
+        packer.entry(writer, 'scaled_units', self.scaled_units)
+        packer.entry(writer, 'unit_id', self.unit_id)
+        packer.entry(writer, 'timestamp', self.timestamp.isoformat())
+        packer.entry(writer, 'interval', str(self.interval.days))
 
         if self.equation:
-            package += '\n'
-            package += self.equation.pack(prefix)
+            writer.write('\n')
+            self.equation.pack_into(writer, prefix)
             
-        return package
+        return
     
     def unpack(self, package):
-        self.procedure_type = package['procedure_type'] 
-        self.scaled_units = package['scaled_units']
-        self.unit_id = package['unit_id']
+        self.procedure_type = package.get('procedure_type')
+        self.scaled_units = package.get('scaled_units')
+        self.unit_id = package.get('unit_id')
         self.timestamp = datetime.date.fromisoformat(package['timestamp'])
         self.interval = datetime.timedelta(days=int(package['interval']))
 
@@ -0,0 +1,333 @@
+#
+# caltable.py - a flat, memory mapped table of deployed calibrations.
+#               part of the python sensor silo project.
+#
+# Copyright (c) 2026 Coburn Wightman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+
+import os
+import math
+import bisect
+import mmap
+import array
+import struct
+import datetime
+import tempfile
+
+
+class CalibrationTable():
+    ''' every deployed calibration as a fixed size record in one read only
+        file. export() writes it, CalibrationTable(filename) maps it and
+        evaluates straight from the mapped coefficients, so any number of
+        processes share one page cache copy instead of building their own
+        Sensor, Calibration and equation objects.
+        tables too long for a record follow the records, and their record
+        holds the table's position there.'''
+
+    magic = b'SILOCALT'
+    version = 2
+    slots = 8 # coefficients per record
+
+    # magic, version, slots, record count, string count, records offset, strings offset
+    header = struct.Struct('<8sHHIIII')
+
+    # sensor id index, type tag, coefficient count, units id index, due date ordinal
+    head = struct.Struct('<IHHIi')
+    record_size = head.size + 8 * slots
+
+    absent = 0xffffffff
+
+    # type tags and the coefficients each stores
+    UNSUPPORTED = 0
+    POLYNOMIAL = 1 # c0, c1, c2 ... ascending power
+    NTC_BETA = 2 # beta, r25, t0
+    PHORP_NTC_BETA = 3 # beta, r25, t0, bias_volts, bias_ohms
+    STEINHART_HART = 4 # a, b, c, t0
+    PHORP_STEINHART_HART = 5 # a, b, c, t0, bias_volts, bias_ohms
+    NTC_TABLE = 6 # t0, ln(ohms) keys ..., 1/kelvin values ...
+    PHORP_NTC_TABLE = 7 # t0, keys ..., values ..., bias_volts, bias_ohms
+
+    tables = (NTC_TABLE, PHORP_NTC_TABLE) # stored after the records
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        self.fp = open(filename, 'rb')
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, slots, self.count, string_count, records_offset, strings_offset = self.header.unpack_from(self.map)
+        if magic != self.magic or version != self.version or slots != self.slots:
+            self.close()
+            raise ValueError('{} is not a version {} calibration table'.format(filename, self.version))
+
+        self.records_offset = records_offset
+
+        # coefficients are read in place through this view, never copied.
+        #  it spans the records and the tables after them.
+        self.view = memoryview(self.map)
+        self.numbers = self.view[records_offset:strings_offset].cast('d')
+        self.tables_first = self.count * self.record_size // 8
+
+        offsets = array.array('I')
+        offsets.frombytes(self.map[strings_offset:strings_offset + 4 * (string_count + 1)])
+        blob_offset = strings_offset + 4 * (string_count + 1)
+        blob = self.map[blob_offset:blob_offset + offsets[-1]]
+        self.strings = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(string_count)]
+
+        self.index = dict()
+        for i in range(self.count):
+            sensor_index = self.head.unpack_from(self.map, records_offset + i * self.record_size)[0]
+            self.index[self.strings[sensor_index]] = i
+
+        return
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, sensor_id):
+        return sensor_id in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def close(self):
+        self.numbers = None
+        if getattr(self, 'view', None) is not None:
+            self.view.release()
+            self.view = None
+
+        try:
+            self.map.close()
+        except BufferError:
+            # an evaluator() still holds a view. the map closes when it is released
+            pass
+
+        self.fp.close()
+
+        return
+
+    def record(self, sensor_id):
+        ''' returns (type tag, coefficients, units id, due date) of sensor_id.
+            coefficients is a view into the mapped file'''
+        i = self.index[sensor_id]
+        sensor_index, tag, count, units, due = self.head.unpack_from(self.map, self.records_offset + i * self.record_size)
+        coefficients = self.coefficients(i, tag, count)
+
+        units_id = None if units == self.absent else self.strings[units]
+        due_date = None if due == 0 else datetime.date.fromordinal(due)
+
+        return (tag, coefficients, units_id, due_date)
+
+    def coefficients(self, i, tag, count):
+        ''' a view of record i's coefficients, or of its table'''
+        first = i * (self.record_size // 8) + self.head.size // 8
+        if tag in self.tables:
+            first = self.tables_first + int(self.numbers[first])
+
+        return self.numbers[first:first + count]
+
+    def units_id(self, sensor_id):
+        return self.record(sensor_id)[2]
+
+    def due_date(self, sensor_id):
+        return self.record(sensor_id)[3]
+
+    def evaluate(self, sensor_id, raw_value):
+        ''' the scaled value of raw_value with sensor_id's calibration'''
+        tag, c, units_id, due_date = self.record(sensor_id)
+
+        return self.evaluate_record(tag, c, raw_value)
+
+    def evaluator(self, sensor_id):
+        ''' returns evaluate(raw_value) for one sensor, with its record located once'''
+        i = self.index[sensor_id]
+        tag, count = self.head.unpack_from(self.map, self.records_offset + i * self.record_size)[1:3]
+        coefficients = self.coefficients(i, tag, count)
+        evaluate_record = self.evaluate_record
+
+        def evaluate(raw_value):
+            return evaluate_record(tag, coefficients, raw_value)
+
+        return evaluate
+
+    @classmethod
+    def evaluate_record(cls, tag, c, x):
+        ''' the equations of thermistor.py and polynomial.py over record coefficients'''
+        if tag == cls.POLYNOMIAL:
+            # the fit is raw = f(scaled). invert it as PolynomialEquation.evaluate_y() does
+            count = len(c)
+            slope = c[1] if count > 1 else 0.0
+            if slope == 0:
+                slope = 0.00001
+
+            y = (x - c[0]) / slope
+            if count > 2:
+                for iteration in range(50):
+                    f = 0.0
+                    df = 0.0
+                    for i in range(count - 1, -1, -1):
+                        df = df * y + f
+                        f = f * y + c[i]
+
+                    if df == 0:
+                        break
+
+                    step = (f - x) / df
+                    y -= step
+                    if abs(step) <= 1e-12 * (1.0 + abs(y)):
+                        break
+
+            return y
+
+        if tag == cls.PHORP_NTC_BETA or tag == cls.PHORP_STEINHART_HART or tag == cls.PHORP_NTC_TABLE:
+            # millivolts across the ntc of a bias divider to ohms
+            bias_volts, bias_ohms = c[-2], c[-1]
+            volts = x / 1000
+            x = volts / ((bias_volts - volts) / bias_ohms)
+            c = c[:-2]
+
+        if tag == cls.NTC_BETA or tag == cls.PHORP_NTC_BETA:
+            beta, r25, t0 = c[0], c[1], c[2]
+            try:
+                kelvin = 1.0 / (1.0/(t0 + 25.0) + (1.0/beta) * math.log(x/r25))
+            except ValueError:
+                kelvin = 0
+            return kelvin - t0
+
+        if tag == cls.STEINHART_HART or tag == cls.PHORP_STEINHART_HART:
+            a, b, k, t0 = c[0], c[1], c[2], c[3]
+            try:
+                ln_r = math.log(x)
+                kelvin = 1.0 / (a + b * ln_r + k * ln_r * ln_r * ln_r)
+            except (ValueError, ZeroDivisionError):
+                kelvin = 0
+            return kelvin - t0
+
+        if tag == cls.NTC_TABLE or tag == cls.PHORP_NTC_TABLE:
+            # NtcTableEquation's interpolant, extrapolating the end segments
+            t0 = c[0]
+            n = (len(c) - 1) // 2
+            keys = c[1:1 + n]
+            values = c[1 + n:]
+            try:
+                ln_r = math.log(x)
+                i = bisect.bisect_right(keys, ln_r, 1, n - 1)
+                k0, k1, v0, v1 = keys[i - 1], keys[i], values[i - 1], values[i]
+                kelvin = 1.0 / (v0 + (v1 - v0) / (k1 - k0) * (ln_r - k0))
+            except (ValueError, ZeroDivisionError):
+                kelvin = 0
+            return kelvin - t0
+
+        raise ValueError('calibration type {} has no flat evaluator'.format(tag))
+
+    @classmethod
+    def tag_of(cls, equation):
+        ''' returns (type tag, coefficients) of an equation'''
+        kind = equation.type
+
+        if kind == 'PolynomialEquation':
+            coefficients = list(equation.coefficients)
+            if len(coefficients) <= cls.slots:
+                return (cls.POLYNOMIAL, coefficients)
+        elif kind == 'NtcBetaEquation':
+            return (cls.NTC_BETA, [equation.beta, equation.r25, equation.t0])
+        elif kind == 'PhorpNtcBetaEquation':
+            return (cls.PHORP_NTC_BETA, [equation.beta, equation.r25, equation.t0, equation.bias_volts, equation.bias_ohms])
+        elif kind == 'SteinhartHartEquation':
+            return (cls.STEINHART_HART, [equation.a, equation.b, equation.c, equation.t0])
+        elif kind == 'PhorpSteinhartHartEquation':
+            return (cls.PHORP_STEINHART_HART, [equation.a, equation.b, equation.c, equation.t0, equation.bias_volts, equation.bias_ohms])
+        elif kind == 'NtcTableEquation':
+            table = equation.index
+            return (cls.NTC_TABLE, [equation.t0] + list(table.keys) + list(table.values))
+        elif kind == 'PhorpNtcTableEquation':
+            table = equation.index
+            return (cls.PHORP_NTC_TABLE, [equation.t0] + list(table.keys) + list(table.values) + [equation.bias_volts, equation.bias_ohms])
+
+        # high degree polynomials and third party equations
+        return (cls.UNSUPPORTED, [])
+
+    @classmethod
+    def export(cls, sensors, filename):
+        ''' write the calibrations of the deployed sensors in sensors, a dict of
+            Sensor. returns the ids whose equations have no flat form.'''
+        strings = []
+        string_index = dict()
+
+        def intern(text):
+            if text is None:
+                return cls.absent
+            if text not in string_index:
+                string_index[text] = len(strings)
+                strings.append(text)
+            return string_index[text]
+
+        records = bytearray()
+        tables = array.array('d')
+        count = 0
+        unsupported = []
+        for s in sensors.values():
+            if not s.is_deployed or s.calibration is None or s.calibration.equation is None:
+                continue
+
+            tag, coefficients = cls.tag_of(s.calibration.equation)
+            if tag == cls.UNSUPPORTED:
+                unsupported.append(s.id)
+
+            due = 0
+            if s.calibration.interval.days != 0:
+                due = s.calibration.due_date.toordinal()
+
+            length = len(coefficients)
+            if tag in cls.tables:
+                # the record holds where the table starts after the records
+                tables.extend(coefficients)
+                coefficients = [float(len(tables) - length)]
+
+            padded = coefficients + [0.0] * (cls.slots - len(coefficients))
+            records += cls.head.pack(intern(s.id), tag, length, intern(s.calibration.unit_id), due)
+            records += struct.pack('<{}d'.format(cls.slots), *padded)
+            count += 1
+
+        encoded = [text.encode('utf-8') for text in strings]
+        offsets = array.array('I', [0])
+        for text in encoded:
+            offsets.append(offsets[-1] + len(text))
+
+        # header padded so the coefficients are 8 byte aligned
+        records_offset = (cls.header.size + 7) // 8 * 8
+        strings_offset = records_offset + len(records) + len(tables) * 8
+        header = cls.header.pack(cls.magic, cls.version, cls.slots, count, len(strings), records_offset, strings_offset)
+
+        # written aside and renamed. readers keep mapping the old file
+        #  rather than seeing it change underneath them.
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, temporary = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(filename)), suffix='.tmp', dir=directory)
+        try:
+            with open(fd, 'wb') as fp:
+                fp.write(header)
+                fp.write(bytes(records_offset - len(header)))
+                fp.write(records)
+                fp.write(tables.tobytes())
+                fp.write(offsets.tobytes())
+                fp.write(b''.join(encoded))
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, filename)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+        return unsupported
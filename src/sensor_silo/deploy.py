@@ -16,9 +16,13 @@
 #
 
 from . import shell
+from . import packer
 
 class DeployShell(shell.Shell):
     intro = 'Sensor Configuration.  x to return to previous menu.'
+
+    # assigning any attribute written by pack() bumps revision
+    packed_attributes = frozenset(['folder_name', 'group_name', 'key_name', 'update_interval', 'over_sample_rate', 'filter_in_percent'])
     # prompt = 'sensor: '
 
     def __init__(self, *kwargs): # sensors
@@ -32,6 +36,8 @@ class DeployShell(shell.Shell):
         self.over_sample_rate = 10 # samples per interval
         self.filter_in_percent = 10 # %
 
+        self.revision = 0
+
         # self.silo_sensors = sensors
         # self.sensors = [] # deployed sensors
         return
@@ -56,6 +62,27 @@ class DeployShell(shell.Shell):
         
         return False
     
+    def __setattr__(self, name, value):
+        if name in self.packed_attributes:
+            self.__dict__['revision'] = self.__dict__.get('revision', 0) + 1
+
+        super().__setattr__(name, value)
+
+        return
+
+    def postcmd(self, stop, line):
+        # any command but these may have edited us
+        if line.split(' ')[0] not in ('', 'x', 'show', 'help', '?'):
+            self.changed()
+
+        return stop
+
+    def changed(self):
+        ''' we have been edited, the saved section is stale'''
+        self.revision += 1
+
+        return
+
     def do_x(self, arg):
         ''' exit to previous menu'''
         return True
@@ -148,30 +175,34 @@ class DeployShell(shell.Shell):
         return False
 
     def pack(self, prefix):
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
         # deploy
 
-        package = ''
-        package += '\n'
-        package += '[{}]\n'.format(prefix)
+        writer.write('\n')
+        writer.write('[{}]\n'.format(prefix))
         
-        package += 'folder_name = "{}"\n'.format(self.folder_name)
-        package += 'group_name = "{}"\n'.format(self.group_name)
-        package += 'key_name = "{}"\n'.format(self.key_name)
+        packer.entry(writer, 'folder_name', self.folder_name)
+        packer.entry(writer, 'group_name', self.group_name)
+        packer.entry(writer, 'key_name', self.key_name)
         
-        package += 'update_interval = {}\n'.format(self.update_interval)
-        package += 'over_sample_rate = {}\n'.format(self.over_sample_rate)
-        package += 'filter_in_percent = {}\n'.format(self.filter_in_percent)
+        packer.entry(writer, 'update_interval', self.update_interval)
+        packer.entry(writer, 'over_sample_rate', self.over_sample_rate)
+        packer.entry(writer, 'filter_in_percent', self.filter_in_percent)
 
-        return package
+        return
 
     def unpack(self, package):
         # deploy
+        self.changed()
+
         self.folder_name = package.get('folder_name', 'folder')
         self.group_name = package.get('group_name', 'group')
         self.key_name = package.get('key_name', 'key')
         
         self.update_interval = package.get('update_interval', 60)
-        self.over_sample_rate = package.get('over_sample_rag', 10)        
+        self.over_sample_rate = package.get('over_sample_rate', 10)
         self.filter_in_percent = package.get('filter_in_percent', 0)
                 
         return
@@ -15,26 +15,264 @@
 # GNU Affero General Public License for more details.
 #
 
+import math
+import bisect
+
+from . import vector
+from . import packer
+
+
+class LookupTable():
+    ''' a monotone table of key, value pairs searched by bisection'''
+    def __init__(self, keys, values):
+        if len(keys) < 2 or len(keys) != len(values):
+            raise ValueError('lookup table needs two or more key, value pairs')
+
+        if keys[0] > keys[-1]:
+            keys = list(reversed(keys))
+            values = list(reversed(values))
+
+        self.keys = vector.new_array(keys)
+        self.values = vector.new_array(values)
+        self.error = None # largest interpolation error seen while building
+
+        for k0, k1 in zip(self.keys, self.keys[1:]):
+            if not k0 < k1:
+                raise ValueError('lookup table keys are not monotone')
+
+        # precomputed interpolation index. bisecting the inner keys picks a
+        # segment, extrapolating the end segments beyond first..last.
+        self.breaks = tuple(self.keys[1:-1])
+        self.slopes = tuple((v1 - v0) / (k1 - k0) for k0, k1, v0, v1
+                            in zip(self.keys, self.keys[1:], self.values, self.values[1:]))
+        self.intercepts = tuple(v0 - m * k0 for k0, v0, m in zip(self.keys, self.values, self.slopes))
+
+        return
+
+    @classmethod
+    def from_function(cls, function, lo, hi, max_error, inverse=False, max_points=65537):
+        ''' tabulate function over lo..hi, doubling the grid until max_error is met.
+            an inverse table is keyed on function(u) and returns u.
+            raises ValueError if function is not finite and monotone over lo..hi,
+            or max_error is not met within max_points'''
+        count = 17
+        while True:
+            step = (hi - lo) / (count - 1)
+            u = [lo + i * step for i in range(count)]
+            v = [cls.finite(function, x) for x in u]
+
+            if inverse:
+                table = cls(v, u)
+            else:
+                table = cls(u, v)
+
+            # the interpolation error is largest between grid points
+            error = 0.0
+            for u0, u1 in zip(u, u[1:]):
+                um = (u0 + u1) / 2
+                vm = cls.finite(function, um)
+                if inverse:
+                    error = max(error, abs(table(vm) - um))
+                else:
+                    error = max(error, abs(table(um) - vm))
+
+            table.error = error
+            if error <= max_error:
+                return table
+
+            if count >= max_points:
+                raise ValueError('lookup table error {:g} exceeds {:g} with {} points'.format(error, max_error, count))
+
+            count = 2 * count - 1
+
+    @staticmethod
+    def finite(function, x):
+        try:
+            value = function(x)
+        except (ArithmeticError, ValueError):
+            value = math.nan
+
+        if not math.isfinite(value):
+            raise ValueError('no finite value at {:g}'.format(x))
+
+        return value
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def first(self):
+        return self.keys[0]
+
+    @property
+    def last(self):
+        return self.keys[-1]
+
+    def __call__(self, key):
+        ''' interpolate key. keys outside first..last extrapolate the end segments'''
+        i = bisect.bisect_right(self.breaks, key)
+
+        return self.intercepts[i] + self.slopes[i] * key
+
+    @vector.rowwise
+    def many(self, keys):
+        ''' __call__() over a buffer of keys'''
+        k = vector.as_ndarray(keys)
+        if k is None:
+            return vector.new_array([self(key) for key in keys])
+
+        np = vector.numpy
+        i = np.searchsorted(np.array(self.breaks), k, side='right')
+
+        return np.array(self.intercepts)[i] + np.array(self.slopes)[i] * k
+
+
 class Equation():
     def __init__(self):
         self.package_prefix = ''
+
+        # bumped whenever the coefficients, or anything else pack() writes, change
+        self.revision = 0
+
+        # bumped whenever evaluate() may change, with revision or the lookup table
+        self.evaluator_revision = 0
+
+        # optional lookup table in place of evaluate_y()
+        self.table_range = None
+        self.table_error = 0.001
+        self._table = None
+
         return
 
     @property
     def type(self):
         return self.__class__.__name__
+
+    def changed(self):
+        ''' coefficients have changed, drop anything derived from them'''
+        self.revision += 1
+        self.invalidate()
+
+        return
+
+    def invalidate(self):
+        ''' evaluation has changed, drop compiled evaluators and the table.
+            what pack() writes has not, see changed()'''
+        self.evaluator_revision += 1
+        self._table = None
+
+        return
+
+    def use_table(self, raw_min, raw_max, max_error=0.001):
+        ''' evaluate raw values in raw_min..raw_max from a precomputed table
+            within max_error scaled units. use_table(None, None) to disable.
+            the table is built here. raises ValueError, leaving the previous
+            table in place, if it cannot be built within max_error'''
+        previous = (self.table_range, self.table_error)
+
+        self.table_range = None
+        if raw_min is not None:
+            self.table_range = (min(raw_min, raw_max), max(raw_min, raw_max))
+
+        self.table_error = max_error
+
+        # compiled evaluators and evaluation caches key on evaluator_revision.
+        #  the table is not packed, so revision stands
+        self.invalidate()
+
+        if self.table_range is not None:
+            try:
+                self._table = self.build_table()
+            except ValueError as error:
+                self.table_range, self.table_error = previous
+                self.invalidate()
+                raise ValueError('no lookup table over {}..{}: {}'.format(raw_min, raw_max, error))
+
+        return
+
+    @property
+    def table(self):
+        if self.table_range is None:
+            return None
+
+        if self._table is None:
+            try:
+                self._table = self.build_table()
+            except ValueError as error:
+                # the coefficients changed under a table that no longer fits.
+                #  evaluate directly rather than fail every sample
+                print(' lookup table disabled: {}'.format(error))
+                self.table_range = None
+                return None
+
+        return self._table
+
+    def build_table(self):
+        ''' tabulate evaluate_y() over the raw range.
+            specialized equations may tabulate their inverse instead.'''
+        lo, hi = self.table_range
+
+        return LookupTable.from_function(self.evaluate_y, lo, hi, self.table_error)
+
+    def evaluate(self, raw_value):
+        ''' evaluate_y() using the lookup table when one is configured'''
+        table = self.table
+        if table is not None and table.first <= raw_value <= table.last:
+            return table(raw_value)
+
+        return self.evaluate_y(raw_value)
+
+    def compile(self):
+        ''' returns a callable equivalent to evaluate() with our state bound as locals.
+            recompile after the coefficients change, see evaluator_revision.'''
+        evaluate_y = self.evaluate_y
+
+        table = self.table
+        if table is None:
+            return evaluate_y
+
+        first = table.first
+        last = table.last
+
+        def evaluate(raw_value):
+            if first <= raw_value <= last:
+                return table(raw_value)
+
+            return evaluate_y(raw_value)
+
+        return evaluate
+
+    @vector.rowwise
+    def evaluate_many(self, raw_values):
+        ''' evaluate() over a buffer of raw values'''
+        table = self.table
+        if table is None:
+            return self.evaluate_y_many(raw_values)
+
+        raw = vector.as_ndarray(raw_values)
+        if raw is None:
+            return vector.new_array([self.evaluate(value) for value in raw_values])
+
+        inside = (raw >= table.first) & (raw <= table.last)
+        if inside.all():
+            return table.many(raw)
+
+        return vector.numpy.where(inside, table.many(raw), self.evaluate_y_many(raw))
     
     def dump(self):
         print(self.pack('me'))
         return
 
     def pack(self, prefix):
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
         self.package_prefix = '{}.{}'.format(prefix, 'equation')
         
-        package = '[{}]\n'.format(self.package_prefix)
-        package += 'type = "{}"\n'.format(self.type)
+        writer.write('[{}]\n'.format(self.package_prefix))
+        packer.entry(writer, 'type', self.type)
 
-        return package
+        return
 
     def unpack(self, package):
         # nothing for us to unpack?
@@ -15,20 +15,78 @@
 # GNU Affero General Public License for more details.
 #
 
-from . import thermistor
-from . import polynomial
+import importlib
+import importlib.metadata
+
 
 class EquationFactory():
+    # equation type name -> equation class. filled in by register()
+    registry = dict()
+
+    # the built in equations, imported on first use
+    modules = {
+        'NtcBetaEquation': 'thermistor',
+        'PhorpNtcBetaEquation': 'thermistor',
+        'SteinhartHartEquation': 'thermistor',
+        'PhorpSteinhartHartEquation': 'thermistor',
+        'NtcTableEquation': 'thermistor',
+        'PhorpNtcTableEquation': 'thermistor',
+        'PolynomialEquation': 'polynomial',
+    }
+
+    # third party equations are advertised as entry points in this group,
+    #  named by their type, ie: MyEquation = "my_package.equations:MyEquation"
+    entry_point_group = 'sensor_silo.equations'
+    entry_points = None
+
     def __init__(self):
         return
 
+    @classmethod
+    def register(cls, equation_class):
+        ''' class decorator that makes an equation creatable by its type name'''
+        cls.registry[equation_class.__name__] = equation_class
+
+        return equation_class
+
+    @classmethod
+    def lookup(cls, type_name):
+        ''' returns the equation class for type_name'''
+        try:
+            return cls.registry[type_name]
+        except KeyError:
+            pass
+
+        if type_name in cls.modules:
+            importlib.import_module('.{}'.format(cls.modules[type_name]), __package__)
+        else:
+            entry_point = cls.find_entry_point(type_name)
+            if entry_point is not None:
+                cls.registry.setdefault(type_name, entry_point.load())
+
+        if type_name not in cls.registry:
+            raise ValueError('unknown equation type "{}"'.format(type_name))
+
+        return cls.registry[type_name]
+
+    @classmethod
+    def find_entry_point(cls, type_name):
+        if cls.entry_points is None:
+            try:
+                found = importlib.metadata.entry_points(group=cls.entry_point_group)
+            except TypeError:
+                # python < 3.10
+                found = importlib.metadata.entry_points().get(cls.entry_point_group, [])
+
+            cls.entry_points = {entry_point.name: entry_point for entry_point in found}
+
+        return cls.entry_points.get(type_name)
+
     def new(self, package):
         # print('creating new {}'.format(package['type']))
-        if package['type'] == 'NtcBetaEquation':
-            equation = thermistor.NtcBetaEquation(package)
-        elif package['type'] == 'PhorpNtcBetaEquation':
-            equation = thermistor.PhorpNtcBetaEquation(package)
-        elif package['type'] == 'PolynomialEquation':
-            equation = polynomial.PolynomialEquation(package)
-
-        return equation
+        equation_class = self.lookup(package['type'])
+
+        return equation_class(package)
+
+
+register = EquationFactory.register
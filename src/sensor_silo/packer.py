@@ -0,0 +1,290 @@
+#
+# packer.py - helpers to stream pack() output to a writer.
+#             part of the python sensor silo project.
+#
+# Copyright (c) 2026 Coburn Wightman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+
+import os
+import re
+import json
+import hashlib
+import math
+import numbers
+import datetime
+
+bare_key = re.compile(r'[A-Za-z0-9_-]+\Z')
+
+
+class Buffer(list):
+    ''' a list buffer with the write() of a text stream.
+        pieces are joined once, by getvalue()'''
+    def write(self, text):
+        self.append(text)
+
+        return len(text)
+
+    def getvalue(self):
+        return ''.join(self)
+
+
+def pack(item, prefix):
+    ''' returns item.pack_into() as a string'''
+    buffer = Buffer()
+    item.pack_into(buffer, prefix)
+
+    return buffer.getvalue()
+
+def section(writer, item, prefix, revision, head=''):
+    ''' write head then item.pack_into(). a Splice writer copies the section
+        from the previous file instead if revision has not changed since'''
+    splice = getattr(writer, 'splice', None)
+    if splice is None:
+        writer.write(head)
+        item.pack_into(writer, prefix)
+    else:
+        splice(item, prefix, revision, head)
+
+    return
+
+
+class Splice():
+    ''' the write() of a text stream over a binary file. sections of the
+        previous file that have not changed are copied rather than packed.
+        each item keeps the byte span of its section in the last file saved,
+        stamped with that file's stat, see commit(). position and digest
+        are the size and sha256 of what has been written.'''
+    def __init__(self, fp, previous=None):
+        self.fp = fp
+        self.previous = None # (binary file, stamp)
+        if previous is not None:
+            self.previous = (previous, self.stamp_of(os.fstat(previous.fileno())))
+
+        self.position = 0
+        self.digest = hashlib.sha256()
+        self.pending = None # (start, length) of previous file not yet copied
+        self.spans = []
+        self.copied = 0
+        self.packed = 0
+
+        return
+
+    @staticmethod
+    def stamp_of(info):
+        return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+    def write(self, text):
+        if self.pending is not None:
+            self.flush()
+
+        data = text.encode('utf-8')
+        self.fp.write(data)
+        self.digest.update(data)
+        self.position += len(data)
+
+        return len(text)
+
+    def splice(self, item, prefix, revision, head=''):
+        start = self.position
+
+        span = item.__dict__.get('packed_span')
+        if self.previous is not None and span is not None and span[:3] == (self.previous[1], prefix, revision):
+            self.copy(span[3], span[4])
+            self.copied += 1
+        else:
+            self.write(head)
+            item.pack_into(self, prefix)
+            self.packed += 1
+
+        self.spans.append((item, prefix, revision, start, self.position - start))
+
+        return
+
+    def copy(self, start, length):
+        # runs of unchanged sections are copied in one go
+        if self.pending is not None:
+            pending_start, pending_length = self.pending
+            if pending_start + pending_length == start:
+                self.pending = (pending_start, pending_length + length)
+                self.position += length
+                return
+
+            self.flush()
+
+        self.pending = (start, length)
+        self.position += length
+
+        return
+
+    def flush(self):
+        ''' copy what is pending from the previous file'''
+        if self.pending is None:
+            return
+
+        start, length = self.pending
+        self.pending = None
+
+        fp = self.previous[0]
+        fp.seek(start)
+
+        remaining = length
+        while remaining:
+            data = fp.read(min(remaining, 65536))
+            if not data:
+                raise ValueError('{} is shorter than when it was saved'.format(fp.name))
+
+            self.fp.write(data)
+            self.digest.update(data)
+            remaining -= len(data)
+
+        return
+
+    def commit(self, info):
+        ''' the file written is saved, info is its stat. it is the previous file next time'''
+        stamp = self.stamp_of(info)
+        for item, prefix, revision, start, length in self.spans:
+            item.packed_span = (stamp, prefix, revision, start, length)
+
+        self.spans = []
+
+        return
+
+
+def encode_key(key):
+    ''' returns key bare if toml allows it, quoted otherwise'''
+    key = str(key)
+    if bare_key.match(key):
+        return key
+
+    return encode_string(key)
+
+def encode_string(value):
+    # json escapes are a subset of toml basic string escapes, except DEL
+    return json.dumps(value, ensure_ascii=False).replace('\x7f', '\\u007f')
+
+def encode_float(value):
+    if math.isfinite(value):
+        return repr(value)
+
+    if math.isnan(value):
+        return 'nan'
+
+    return 'inf' if value > 0 else '-inf'
+
+def encode(value):
+    ''' returns value as a toml value. None has no toml form, see entry()'''
+    kind = type(value)
+    if kind is str:
+        return encode_string(value)
+    if kind is float:
+        return encode_float(value)
+    if kind is int:
+        return repr(value)
+    if kind is bool:
+        return 'true' if value else 'false'
+
+    # subclasses, numpy scalars and sequences
+    if isinstance(value, str):
+        return encode_string(str(value))
+    if isinstance(value, numbers.Integral):
+        return repr(int(value))
+    if isinstance(value, numbers.Real):
+        return encode_float(float(value))
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)) or hasattr(value, 'tolist'):
+        return '[{}]'.format(', '.join(encode(item) for item in value))
+
+    raise ValueError('no toml encoding for {!r}'.format(value))
+
+def entry(writer, key, value):
+    ''' write key = value. a None value is omitted, unpack() reads it back with get()'''
+    if value is None:
+        return
+
+    writer.write('{} = {}\n'.format(encode_key(key), encode(value)))
+
+    return
+
+
+if __name__ == '__main__':
+    # round trip random sensor databases. python -m sensor_silo.packer
+    import random
+    import tomllib
+
+    from . import sensor
+    from . import calibration
+    from . import polynomial
+    from . import thermistor
+
+    alphabet = 'abc XYZ 019 ."\'\\#=[]{}\t\n\r\x00\x1f\x7f é€🌡'
+
+    def text(rnd):
+        return ''.join(rnd.choice(alphabet) for i in range(rnd.randint(0, 12)))
+
+    def number(rnd):
+        return rnd.choice([0.0, -0.0, 1e-300, 1e300, 0.1, 1.0/3, rnd.uniform(-1e6, 1e6), rnd.random()])
+
+    def new_equation(rnd):
+        kind = rnd.choice(['polynomial', 'beta', 'steinhart', 'table'])
+        if kind == 'polynomial':
+            equation = polynomial.PolynomialEquation()
+            equation.degree = rnd.randint(1, 4)
+            equation.coefficients = [number(rnd) for i in range(equation.degree + 1)]
+        elif kind == 'beta':
+            equation = thermistor.PhorpNtcBetaEquation()
+            equation.beta = number(rnd)
+            equation.r25 = number(rnd)
+        elif kind == 'steinhart':
+            equation = thermistor.PhorpSteinhartHartEquation()
+            equation.a, equation.b, equation.c = number(rnd), number(rnd), number(rnd)
+        else:
+            equation = thermistor.PhorpNtcTableEquation()
+            ohms = sorted(rnd.uniform(100, 1e6) for i in range(rnd.randint(2, 8)))
+            equation.set_points(ohms, [rnd.uniform(-40, 125) for r in ohms])
+
+        return equation
+
+    def new_sensors(rnd, count):
+        sensors = sensor.Sensors()
+        for i in range(count):
+            s = sensor.Sensor('{}{}'.format(text(rnd), i))
+            s.kind = rnd.choice([None, 'ph', text(rnd)])
+            s.name = text(rnd)
+            s.location = text(rnd)
+            s.property = text(rnd)
+            s.stream_type = rnd.choice([None, text(rnd)])
+            s.address = text(rnd)
+
+            s.calibration = calibration.Calibration()
+            s.calibration.procedure_type = rnd.choice([None, text(rnd)])
+            s.calibration.scaled_units = text(rnd)
+            s.calibration.unit_id = rnd.choice([None, text(rnd)])
+            s.calibration.timestamp = datetime.date.today()
+            s.calibration.interval = datetime.timedelta(days=rnd.randint(1, 365))
+            s.calibration.equation = new_equation(rnd)
+
+            sensors[s.id] = s
+
+        return sensors
+
+    rnd = random.Random(0)
+    for trial in range(200):
+        sensors = new_sensors(rnd, rnd.randint(1, 8))
+        document = '[sensors]\n' + sensors.pack('sensors')
+        loaded = sensor.Sensors(tomllib.loads(document)['sensors'])
+
+        assert list(loaded.keys()) == list(sensors.keys())
+        assert '[sensors]\n' + loaded.pack('sensors') == document
+
+    print('ok: 200 random sensor databases round trip')
@@ -16,6 +16,7 @@
 #
 
 from . import shell
+from . import packer
 
 class Parameter():
     def __init__(self):
@@ -77,15 +78,17 @@ class ParameterShell(shell.Shell):
         return
 
     def pack(self, prefix):
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
         # Constant parameter
-        package = ''
-        package += '[{}]\n'.format(prefix)
+        writer.write('[{}]\n'.format(prefix))
         
-        package += 'name = "{}"\n'.format(self.name)
-        package += 'scaled_units = "{}"\n'.format(self.scaled_units)
-        package += 'scaled_value = {}\n'.format(self.scaled_value)
+        packer.entry(writer, 'name', self.name)
+        packer.entry(writer, 'scaled_units', self.scaled_units)
+        packer.entry(writer, 'scaled_value', self.scaled_value)
 
-        return package
+        return
 
     def unpack(self, package):
         # constant parameter
@@ -15,19 +15,28 @@
 # GNU Affero General Public License for more details.
 #
 
+import math
+import array
 import datetime
 
 from . import procedure
 from . import setpoint as sp
 from . import equation
+from . import factory
 from . import quantity
+from . import vector
+from . import packer
+from . import statistics as rs
 
 
 class PolynomialProcedure(procedure.ProcedureShell):
+    packed_attributes = procedure.ProcedureShell.packed_attributes | {'point_count', 'degree'}
+
     def __init__(self, streams, *kwargs):
         super().__init__(streams, *kwargs)
 
         self.point_count = 2 # spread_count?
+        self.degree = 1
         
         return
 
@@ -43,20 +52,79 @@ class PolynomialProcedure(procedure.ProcedureShell):
     def sp3(self):
         return self.parameters['sp3']
         
-    # def do_spread(self, arg):
-    #     ''' spread <n> Calibration point count, 2 or 3'''
+    def do_spread(self, arg):
+        ''' spread <n> Calibration point count, 2 or 3'''
+        
+        try:
+            if int(arg) not in [2,3] or int(arg) > len(self.parameters):
+                print(' possible point count is {}'.format([2,3][:len(self.parameters)-1]))
+            else:
+                self.point_count = int(arg)
+                if self.degree >= self.point_count:
+                    self.degree = self.point_count - 1
+        except:
+            print(' possible choices are 2 or 3')
+            
+        self.do_show()
+        
+        return False
+
+    def do_degree(self, arg):
+        ''' degree <n> Degree of the fitted polynomial, at most spread - 1'''
         
-    #     try:
-    #         if int(arg) > len(self.parameters): # not in [2,3]:
-    #             print(' possible point count is {}'.format([2,3]))
-    #         else:
-    #             self.point_count = int(arg)
-    #     except:
-    #         print(' possible choices are 2 or 3')
+        try:
+            if int(arg) < 1 or int(arg) >= self.point_count:
+                print(' possible degree is 1 to {}'.format(self.point_count - 1))
+            else:
+                self.degree = int(arg)
+        except:
+            print(' invalid value: degree unchanged.')
             
-    #     self.do_show()
+        self.do_show()
         
-    #     return False
+        return False
+
+    def do_converge(self, arg):
+        ''' converge <sem|drift|off> [threshold mV] End setpoint sampling early once stable'''
+
+        args = arg.split()
+        try:
+            mode = args[0].lower()
+            if mode not in ['sem', 'drift', 'off']:
+                raise ValueError
+
+            threshold = None
+            if len(args) > 1:
+                threshold = float(args[1])
+        except:
+            print(' possible choices are sem, drift or off, with an optional threshold in mV')
+        else:
+            for setpoint in self.parameters.values():
+                if isinstance(setpoint, sp.StreamSetpoint):
+                    setpoint.convergence = None if mode == 'off' else mode
+                    if threshold is not None:
+                        setpoint.threshold = threshold
+
+        self.do_show()
+
+        return False
+
+    def do_estimator(self, arg):
+        ''' estimator <mean|median|trimmed|mad> How setpoint samples are reduced to a measured value'''
+
+        name = arg.strip().lower()
+        try:
+            rs.robust_estimator(name)
+        except ValueError as err:
+            print(' {}'.format(err))
+        else:
+            for setpoint in self.parameters.values():
+                if isinstance(setpoint, sp.StreamSetpoint):
+                    setpoint.estimator = name
+
+        self.do_show()
+
+        return False
 
     def do_sp1(self, arg):
         ''' sp1 <n> The first (lowest value) in a two or three point calibration'''
@@ -97,10 +165,19 @@ class PolynomialProcedure(procedure.ProcedureShell):
     def show(self):
         print('  Units:  {}'.format(self.scaled_units))
         print('  Spread: {} point'.format(self.point_count))
+        print('  Degree: {}'.format(self.degree))
+        for setpoint in self.parameters.values():
+            if getattr(setpoint, 'convergence', None) is not None:
+                print('  Converge: {} < {} mV'.format(setpoint.convergence, setpoint.threshold))
+                break
+        for setpoint in self.parameters.values():
+            if getattr(setpoint, 'estimator', 'mean') != 'mean':
+                print('  Estimator: {}'.format(setpoint.estimator))
+                break
         print('   {}'.format(self.sp1.target_quantity))
         print('   {}'.format(self.sp2.target_quantity))
         if self.point_count == 3:
-            print('   SP3:   {} {}'.format(self.sp3.target_quantity))
+            print('   {}'.format(self.sp3.target_quantity))
 
         return
 
@@ -132,28 +209,30 @@ class PolynomialProcedure(procedure.ProcedureShell):
         return ok
 
     def save(self, sensor):
-        p1 = sensor.calibration.parameters['sp1']
-        p2 = sensor.calibration.parameters['sp2']
-        
-        ok = sensor.calibration.equation.generate(p1, p2)            
+        setpoints = list(sensor.calibration.parameters.values())
+
+        sensor.calibration.equation.degree = self.degree
+        ok = sensor.calibration.equation.generate(*setpoints)
 
         return ok
 
-    def pack(self, prefix):
-        package = super().pack(prefix)
-        package += 'point_count = {}\n'.format(self.point_count)
+    def pack_into(self, writer, prefix):
+        super().pack_into(writer, prefix)
+        packer.entry(writer, 'point_count', self.point_count)
+        packer.entry(writer, 'degree', self.degree)
 
         my_prefix = '{}.{}'.format(prefix, 'parameters')
         for name, parameter in self.parameters.items():
-            parameter_prefix = '{}.{}'.format(my_prefix, name)
-            package += '\n'
-            package += parameter.pack(parameter_prefix)
+            parameter_prefix = '{}.{}'.format(my_prefix, packer.encode_key(name))
+            writer.write('\n')
+            parameter.pack_into(writer, parameter_prefix)
         
-        return package
+        return
 
     def unpack(self, package):
         super().unpack(package)
         self.point_count = package['point_count']
+        self.degree = package.get('degree', 1)
 
         # need a parameter factory and move to Procedure
         if 'parameters' in package:
@@ -164,14 +243,65 @@ class PolynomialProcedure(procedure.ProcedureShell):
             
         return
     
+class Coefficients():
+    ''' the coefficients of a PolynomialEquation, in ascending power.
+        reads like a tuple. assigning an item, or the next power, replaces the
+        coefficients so the equation recompiles. keys(), values() and items()
+        remain from when coefficients was a plain dict.'''
+    def __init__(self, equation):
+        self.equation = equation
+
+        return
+
+    def __len__(self):
+        return len(self.equation._coefficients)
+
+    def __getitem__(self, index):
+        return self.equation._coefficients[index]
+
+    def __setitem__(self, index, value):
+        coefficients = list(self.equation._coefficients)
+        if index == len(coefficients):
+            coefficients.append(value)
+        else:
+            coefficients[index] = value
+
+        self.equation.coefficients = coefficients
+
+        return
+
+    def __iter__(self):
+        return iter(tuple(self.equation._coefficients))
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+    def keys(self):
+        return range(len(self))
+
+    def values(self):
+        return tuple(self)
+
+    def items(self):
+        return list(enumerate(self))
+
+
+@factory.register
 class PolynomialEquation(equation.Equation):
     def __init__(self, package=None):
         super().__init__()
         
         self.degree = 1
-        self.coefficients = dict()
-        self.coefficients[0] = 0.0
-        self.coefficients[1] = 1.0
+        self.coefficients = [0.0, 1.0]
 
         if package:
             self.unpack(package)
@@ -179,36 +309,243 @@ class PolynomialEquation(equation.Equation):
         return
 
     def __len__(self):
-        return len(self.coefficients)
+        return len(self._coefficients)
+
+    @property
+    def degree(self):
+        return self._degree
+
+    @degree.setter
+    def degree(self, degree):
+        self._degree = degree
+        self.changed()
+        return
 
-    def generate(self, p1, p2):
+    @property
+    def coefficients(self):
+        ''' coefficients in ascending power, y = c[0] + c[1]*x + c[2]*x**2 ...
+            a live Coefficients view, coefficients[i] = x still works'''
+        return Coefficients(self)
+
+    @coefficients.setter
+    def coefficients(self, coefficients):
+        if isinstance(coefficients, dict):
+            # the {power: coefficient} dict coefficients used to be
+            coefficients = [coefficients.get(i, 0.0) for i in range(max(coefficients, default=0) + 1)]
+
+        self._coefficients = array.array('d', coefficients)
+
+        # highest power first for horner's scheme
+        self._horner = tuple(reversed(self._coefficients))
+        self._derivative = tuple(reversed([i * c for i, c in enumerate(self._coefficients)][1:]))
+
+        self.changed()
+
+        return
+
+    def generate(self, *setpoints):
+        ''' weighted least squares fit of measured to target over setpoints'''
         is_valid = False
-        try:
-            dx = p2.target_quantity.value - p1.target_quantity.value
-            dy = p2.measured_quantity.value - p1.measured_quantity.value
-            self.coefficients[1] = dy / dx
-            self.coefficients[0] = p1.measured_quantity.value - self.coefficients[1] * p1.target_quantity.value
-            
+
+        if self.degree == 1 and len(setpoints) == 2:
+            p1, p2 = setpoints
+            try:
+                dx = p2.target_quantity.value - p1.target_quantity.value
+                dy = p2.measured_quantity.value - p1.measured_quantity.value
+                slope = dy / dx
+                self.coefficients = [p1.measured_quantity.value - slope * p1.target_quantity.value, slope]
+
+                is_valid = True
+            except ZeroDivisionError:
+                self.coefficients = [0.0, 0.00001]
+
+            return is_valid
+
+        x_values = [p.target_quantity.value for p in setpoints]
+        y_values = [p.measured_quantity.value for p in setpoints]
+        weights = setpoint_weights(setpoints)
+
+        coefficients = least_squares(x_values, y_values, weights, self.degree)
+        if coefficients is None:
+            coefficients = [0.0, 0.00001] + [0.0] * (self.degree - 1)
+        else:
             is_valid = True
-        except ZeroDivisionError:
-            self.coefficients[1] = 0.00001
-            self.coefficients[0] = 0.0
+
+        self.coefficients = coefficients
 
         return is_valid
     
     def evaluate_x(self, x_value):
-        y = self.coefficients[1] * x_value + self.coefficients[0]
+        horner = self._horner
+
+        y = horner[0]
+        for c in horner[1:]:
+            y = y * x_value + c
         
         return y
 
     def evaluate_y(self, y_value):
-        slope = self.coefficients[1]
+        c = self._coefficients
+
+        slope = c[1] if len(c) > 1 else 0.0
         if slope == 0:
             slope = 0.00001
 
-        x = (y_value - self.coefficients[0]) / slope
+        x = (y_value - c[0]) / slope
+
+        if len(c) > 2:
+            # no closed form inverse. polish the linear estimate with newton's method.
+            x = self.newton(y_value, x)
         
         return x
+
+    def compile(self):
+        c = self._coefficients
+        if len(c) != 2 or self.table_range is not None:
+            return super().compile()
+
+        offset = c[0]
+        slope = c[1]
+        if slope == 0:
+            slope = 0.00001
+
+        def evaluate_y(y_value):
+            return (y_value - offset) / slope
+
+        return evaluate_y
+
+    def newton(self, y_value, x, iterations=50, tolerance=1e-12):
+        ''' refine x so evaluate_x(x) == y_value. falls back to bisection when
+            newton's method does not converge'''
+        horner = self._horner
+        derivative = self._derivative
+        start = x
+
+        for i in range(iterations):
+            y = horner[0]
+            dy = derivative[0]
+            for c in horner[1:]:
+                y = y * x + c
+            for c in derivative[1:]:
+                dy = dy * x + c
+
+            if dy == 0:
+                break
+
+            step = (y - y_value) / dy
+            x -= step
+            if abs(step) <= tolerance * (1.0 + abs(x)):
+                return x
+
+        return self.bisect(y_value, start, tolerance)
+
+    def bisect(self, y_value, x, tolerance=1e-12):
+        ''' solve evaluate_x(x) == y_value by bisection, widening a bracket
+            around the estimate x. nan if there is no root, such as a raw value
+            outside the range of an even degree fit. like the out of domain
+            thermistor values this is masked rather than raised, evaluate_y()
+            is on the sampling path'''
+        f = self.evaluate_x
+
+        width = 1e-3 * (1.0 + abs(x))
+        for i in range(64):
+            lo = x - width
+            hi = x + width
+            f_lo = f(lo) - y_value
+            f_hi = f(hi) - y_value
+            if f_lo * f_hi <= 0:
+                break
+            width *= 2
+        else:
+            return math.nan
+
+        if f_lo == 0:
+            return lo
+
+        for i in range(200):
+            mid = (lo + hi) / 2
+            f_mid = f(mid) - y_value
+            if f_mid == 0 or (hi - lo) / 2 <= tolerance * (1.0 + abs(mid)):
+                return mid
+
+            if (f_mid < 0) == (f_lo < 0):
+                lo, f_lo = mid, f_mid
+            else:
+                hi = mid
+
+        return (lo + hi) / 2
+
+    def build_table(self):
+        ''' tabulate the inverse, evaluate_x() on a grid over the scaled range'''
+        lo, hi = [self.evaluate_y(raw) for raw in self.table_range]
+        if not (math.isfinite(lo) and math.isfinite(hi)):
+            raise ValueError('raw range {}..{} has no inverse'.format(*self.table_range))
+
+        if lo > hi:
+            lo, hi = hi, lo
+
+        return equation.LookupTable.from_function(self.evaluate_x, lo, hi, self.table_error, inverse=True)
+
+    @vector.rowwise
+    def evaluate_x_many(self, x_values):
+        ''' evaluate_x() over a sequence, array.array or ndarray of x values'''
+        horner = self._horner
+
+        x = vector.as_ndarray(x_values)
+        if x is not None:
+            y = vector.numpy.full_like(x, horner[0])
+            for c in horner[1:]:
+                y = y * x + c
+            return y
+
+        return vector.new_array([self.evaluate_x(x) for x in x_values])
+
+    @vector.rowwise
+    def evaluate_y_many(self, y_values):
+        ''' evaluate_y() over a sequence, array.array or ndarray of y values'''
+        c = self._coefficients
+        slope = c[1] if len(c) > 1 else 0.0
+        if slope == 0:
+            slope = 0.00001
+
+        y = vector.as_ndarray(y_values)
+        if y is None:
+            return vector.new_array([self.evaluate_y(y) for y in y_values])
+
+        x = (y - c[0]) / slope
+        if len(c) > 2:
+            x = self.newton_many(y, x)
+
+        return x
+
+    def newton_many(self, y_values, x, iterations=50, tolerance=1e-12):
+        np = vector.numpy
+        horner = self._horner
+        derivative = self._derivative
+
+        start = x
+        x = x.copy()
+        for i in range(iterations):
+            y = np.full_like(x, horner[0])
+            dy = np.full_like(x, derivative[0])
+            for c in horner[1:]:
+                y = y * x + c
+            for c in derivative[1:]:
+                dy = dy * x + c
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step = np.where(dy == 0, np.inf, (y - y_values) / dy)
+
+            converged = np.abs(step) <= tolerance * (1.0 + np.abs(x))
+            x -= np.where(dy == 0, 0.0, step)
+            if np.all(converged):
+                return x
+
+        # the stragglers fall back to bisection, see newton()
+        for i in np.flatnonzero(~converged):
+            x[i] = self.bisect(float(y_values[i]), float(start[i]), tolerance)
+
+        return x
     
     # def dump(self):
     #     for key, value in self.coefficients.items():
@@ -216,24 +553,83 @@ class PolynomialEquation(equation.Equation):
 
     #     return
     
-    def pack(self, prefix):
-        package = super().pack(prefix)
+    def pack_into(self, writer, prefix):
+        super().pack_into(writer, prefix)
 
-        package += 'degree = {}\n'.format(self.degree)
+        packer.entry(writer, 'degree', self.degree)
 
-        package += '[{}.{}]\n'.format(self.package_prefix, 'coefficients')
-        for key, value in self.coefficients.items():
-            package += '{} = {}\n'.format(key, value)
+        writer.write('[{}.{}]\n'.format(self.package_prefix, 'coefficients'))
+        for key, value in enumerate(self._coefficients):
+            packer.entry(writer, key, value)
 
-        return package
+        return
 
     def unpack(self, package):
         super().unpack(package)
         
         self.degree = package['degree']
-        
+
+        coefficients = dict()
         for name, value in package['coefficients'].items():
-            self.coefficients[int(name)] = value
+            coefficients[int(name)] = value
+
+        size = max(len(self._coefficients), max(coefficients, default=0) + 1)
+        self.coefficients = [coefficients.get(i, 0.0) for i in range(size)]
         
         return
 
+
+def setpoint_weights(setpoints):
+    ''' inverse variance weights. setpoints without spread are trusted most'''
+    variances = []
+    for setpoint in setpoints:
+        variance = 0.0
+        stats = getattr(setpoint, 'stats', None)
+        if stats is not None and stats.n > 1:
+            variance = stats.variance()
+        variances.append(variance)
+
+    spread = [v for v in variances if v > 0]
+    if not spread:
+        return [1.0] * len(setpoints)
+
+    floor = min(spread)
+    return [1.0 / max(v, floor) for v in variances]
+
+def least_squares(x_values, y_values, weights, degree):
+    ''' returns ascending coefficients of the weighted fit, None if underdetermined'''
+    size = degree + 1
+    if len(set(x_values)) < size:
+        return None
+
+    # normal equations (VtWV)c = VtWy
+    powers = [0.0] * (2 * size - 1)
+    rhs = [0.0] * size
+    for x, y, w in zip(x_values, y_values, weights):
+        p = w
+        for k in range(2 * size - 1):
+            powers[k] += p
+            if k < size:
+                rhs[k] += p * y
+            p *= x
+
+    a = [[powers[i + j] for j in range(size)] + [rhs[i]] for i in range(size)]
+
+    # gaussian elimination with partial pivoting
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda row: abs(a[row][col]))
+        if a[pivot][col] == 0:
+            return None
+        a[col], a[pivot] = a[pivot], a[col]
+
+        for row in range(col + 1, size):
+            factor = a[row][col] / a[col][col]
+            for k in range(col, size + 1):
+                a[row][k] -= factor * a[col][k]
+
+    coefficients = [0.0] * size
+    for row in reversed(range(size)):
+        total = a[row][size] - sum(a[row][k] * coefficients[k] for k in range(row + 1, size))
+        coefficients[row] = total / a[row][row]
+
+    return coefficients
@@ -18,10 +18,15 @@
 import datetime
 
 from . import shell
+from . import packer
 
 class ProcedureShell(shell.Shell):
     intro = 'Generic Procedure Configuration'
 
+    # assigning any attribute written by pack() bumps revision.
+    # edits inside parameters are caught by postcmd() or changed()
+    packed_attributes = frozenset(['kind', 'scaled_units', 'unit_id', 'stream_type', 'stream_address', 'interval'])
+
     def __init__(self, streams, *kwargs):
         super().__init__(*kwargs)
 
@@ -37,6 +42,8 @@ class ProcedureShell(shell.Shell):
         self.unit_id = None
         self.interval = datetime.timedelta(days=180)
 
+        self.revision = 0
+
         return
 
     @property
@@ -58,6 +65,27 @@ class ProcedureShell(shell.Shell):
         
         return False
     
+    def __setattr__(self, name, value):
+        if name in self.packed_attributes:
+            self.__dict__['revision'] = self.__dict__.get('revision', 0) + 1
+
+        super().__setattr__(name, value)
+
+        return
+
+    def postcmd(self, stop, line):
+        # any command but these may have edited us
+        if line.split(' ')[0] not in ('', 'x', 'show', 'help', '?'):
+            self.changed()
+
+        return stop
+
+    def changed(self):
+        ''' we have been edited, the saved section is stale'''
+        self.revision += 1
+
+        return
+
     def do_x(self, arg):
         ''' exit to previous menu'''
         return True
@@ -152,26 +180,30 @@ class ProcedureShell(shell.Shell):
         raise NotImplemented
     
     def pack(self, prefix):
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
         # Procedure
-        package = ''
-        package += 'type = "{}"\n'.format(self.type)
-        package += 'kind = "{}"\n'.format(self.kind)
-        package += 'scaled_units = "{}"\n'.format(self.scaled_units)
-        package += 'unit_id = "{}"\n'.format(self.unit_id)
-        package += 'stream_type = "{}"\n'.format(self.stream_type)
-        package += 'stream_address = "{}"\n'.format(self.stream_address)
-        package += 'interval = {}\n'.format(self.interval.days)
+        packer.entry(writer, 'type', self.type)
+        packer.entry(writer, 'kind', self.kind)
+        packer.entry(writer, 'scaled_units', self.scaled_units)
+        packer.entry(writer, 'unit_id', self.unit_id)
+        packer.entry(writer, 'stream_type', self.stream_type)
+        packer.entry(writer, 'stream_address', self.stream_address)
+        packer.entry(writer, 'interval', self.interval.days)
         
-        return package
+        return
 
     def unpack(self, package):
         # procedure
         ### self.type = package['type'] dont override our own type
-        self.kind = package['kind']
-        self.scaled_units = package['scaled_units']
-        self.unit_id = package['unit_id']
-        self.stream_type = package['stream_type']
-        self.stream_address = package['stream_address']
+        self.changed()
+
+        self.kind = package.get('kind')
+        self.scaled_units = package.get('scaled_units')
+        self.unit_id = package.get('unit_id')
+        self.stream_type = package.get('stream_type')
+        self.stream_address = package.get('stream_address')
         self.interval = datetime.timedelta(days=package['interval'])
 
         return
@@ -235,15 +267,14 @@ class Procedures(shell.Shell):
         return False
 
     def pack(self, prefix):
-        package = ''
-        
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
         for key, procedure in self.procedures.items():
-            my_prefix = '{}.{}'.format(prefix, key)
-            package += '\n'
-            package += '[{}]\n'.format(my_prefix)
-            package += procedure.pack(my_prefix)
+            my_prefix = '{}.{}'.format(prefix, packer.encode_key(key))
+            packer.section(writer, procedure, my_prefix, procedure.revision, '\n[{}]\n'.format(my_prefix))
             
-        return package
+        return
 
     def unpack(self, package):
         for key, template in package.items():
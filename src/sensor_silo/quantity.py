@@ -16,6 +16,7 @@
 #
 
 from . import shell
+from . import packer
 
 class Quantity(): # Parameter?
     def __init__(self, name='name', units='units', value=None, prefix=None, package=None):
@@ -85,24 +86,26 @@ class Quantity(): # Parameter?
         return
     
     def pack(self, prefix):
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
         # Constant parameter
-        package = ''
-        package += '[{}]\n'.format(prefix)
-        package += 'type = "{}"\n'.format(self.type)
+        writer.write('[{}]\n'.format(prefix))
+        packer.entry(writer, 'type', self.type)
         
-        package += 'name = "{}"\n'.format(self._name)
-        package += 'value = {}\n'.format(self._value)
-        package += 'units = "{}"\n'.format(self._units)
-        package += 'prefix = "{}"\n'.format(self._prefix)
+        packer.entry(writer, 'name', self._name)
+        packer.entry(writer, 'value', self._value)
+        packer.entry(writer, 'units', self._units)
+        packer.entry(writer, 'prefix', self._prefix)
 
-        return package
+        return
 
     def unpack(self, package):
         # constant parameter
         self._name = package['name']
-        self._value = package['value']
+        self._value = package.get('value')
         self._units = package['units']
-        self._prefix = package['prefix']
+        self._prefix = package.get('prefix')
 
         return
 
@@ -0,0 +1,164 @@
+#
+# runtime.py - a headless sampling loop for a deployment.
+#              part of the python sensor silo project.
+#
+# Copyright (c) 2026 Coburn Wightman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+
+import time
+
+from . import sensor
+from . import statistics
+
+
+class PrintSink():
+    ''' the simplest sink. prints each interval'''
+    def put(self, timestamp, results):
+        values = ', '.join('{} {}'.format(key, round(value, 3)) for key, value in results.items())
+        print('{}: {}'.format(timestamp, values))
+
+        return
+
+
+class Runtime():
+    ''' samples the deployed sensors of a loaded and connected Deploy
+        over_sample_rate times per stream_period, on absolute deadlines so
+        the loop does not drift. each sample is filtered per sensor with the
+        deployments time_constant and at the end of every interval the
+        filtered values are handed to sink.put(timestamp, results).
+        timestamps are the interval deadlines, in wallclock time.'''
+    def __init__(self, project, sink, clock=time.monotonic, sleep=time.sleep, wallclock=time.time):
+        self.project = project
+        self.sink = sink
+        self.clock = clock
+        self.sleep = sleep
+        self.wallclock = wallclock
+
+        # a deployed sensor without a calibration has nothing to scale with
+        self.sensors = []
+        self.skipped = []
+        for s in project.sensors.values():
+            if not s.is_deployed:
+                continue
+
+            if s.calibration is None or s.calibration.equation is None:
+                print(' {} skipped: no calibration.'.format(s.id))
+                self.skipped.append(s.id)
+                continue
+
+            self.sensors.append(s)
+
+        self.sampler = sensor.Sampler(self.sensors)
+
+        self.filters = dict()
+        for s in self.sensors:
+            self.filters[s.id] = statistics.EwmaStats(project.time_constant)
+
+        # metrics
+        self.jitter = statistics.RunningStats() # seconds late starting each sample
+        self.max_jitter = 0.0
+        self.busy = statistics.RunningStats() # seconds spent sampling
+        self.overruns = 0 # deadlines skipped because sampling ran long
+        self.masked = 0 # readings left out of the filters as nan
+        self.samples = 0
+        self.intervals = 0
+
+        self.running = False
+
+        return
+
+    @property
+    def utilization(self):
+        ''' fraction of the sample period spent sampling'''
+        return self.busy.mean() / self.project.sample_period
+
+    @property
+    def synopsis(self):
+        return 'samples={}, intervals={}, jitter mean={}s max={}s, utilization={}%, overruns={}, masked={}, skipped={}'.format(
+            self.samples, self.intervals, round(self.jitter.mean(), 6), round(self.max_jitter, 6),
+            round(self.utilization * 100, 1), self.overruns, self.masked, len(self.skipped))
+
+    def sample(self):
+        ''' update and filter every deployed sensor once'''
+        self.sampler.sweep()
+
+        for s in self.sensors:
+            value = s.scaled_value
+            if value == value:
+                self.filters[s.id].push(value)
+            else:
+                # nan, a raw value the calibration cannot invert. keep it out of the filter
+                self.masked += 1
+
+        self.samples += 1
+
+        return
+
+    def publish(self, timestamp):
+        results = dict()
+        for key, stats in self.filters.items():
+            results[key] = stats.mean()
+
+        self.sink.put(timestamp, results)
+        self.intervals += 1
+
+        return
+
+    def stop(self):
+        self.running = False
+
+        return
+
+    def run(self, intervals=None):
+        ''' sample until stop(), or for a number of intervals.
+            sample i is due at start + i * sample_period and an interval is
+            published once the grid crosses a stream_period boundary, so
+            overruns skip samples without moving the publish schedule.'''
+        period = self.project.sample_period
+        over_sample_rate = self.project.over_sample_rate
+
+        self.running = True
+        start = self.clock()
+        epoch = self.wallclock() - start # maps our clock onto wallclock time
+        tick = 0
+
+        while self.running:
+            deadline = start + tick * period
+            now = self.clock()
+            if now < deadline:
+                self.sleep(deadline - now)
+                now = self.clock()
+
+            late = now - deadline
+            self.jitter.push(late)
+            self.max_jitter = max(self.max_jitter, late)
+
+            self.sample()
+            done = self.clock()
+            self.busy.push(done - now)
+
+            # next deadline on the original grid, skipping any we have already missed
+            next_tick = tick + 1
+            if done > start + next_tick * period:
+                next_tick = int((done - start) / period) + 1
+                self.overruns += next_tick - tick - 1
+
+            interval = next_tick // over_sample_rate
+            if interval > tick // over_sample_rate:
+                self.publish(epoch + start + interval * over_sample_rate * period)
+                if intervals is not None and self.intervals >= intervals:
+                    self.running = False
+
+            tick = next_tick
+
+        return
@@ -15,11 +15,136 @@
 # GNU Affero General Public License for more details.
 #
 
+import time
+import bisect
+import asyncio
+import weakref
 import collections
 
 from . import shell
+from . import packer
 from . import calibration
+from . import vector
 
+class EvaluationCache():
+    ''' bounded lru cache of scaled values keyed on the quantized raw value'''
+    def __init__(self, size=256, quantum=None):
+        self.size = size
+        self.quantum = quantum # raw units per adc code, None to key on the raw value
+
+        self.values = collections.OrderedDict()
+        self.equation = None
+        self.revision = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        return
+
+    def __len__(self):
+        return len(self.values)
+
+    def clear(self):
+        self.values.clear()
+        self.equation = None
+        self.revision = None
+
+        return
+
+    def evaluate(self, equation, raw_value):
+        if equation is not self.equation or equation.evaluator_revision != self.revision:
+            # calibration, coefficients or lookup table changed since we filled the cache
+            self.clear()
+            self.equation = equation
+            self.revision = equation.evaluator_revision
+
+        key = raw_value
+        if self.quantum:
+            key = round(raw_value / self.quantum)
+            raw_value = key * self.quantum
+
+        values = self.values
+        try:
+            value = values[key]
+        except KeyError:
+            self.misses += 1
+            value = equation.evaluate(raw_value)
+            values[key] = value
+            if len(values) > self.size:
+                values.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            values.move_to_end(key)
+
+        return value
+
+    @property
+    def synopsis(self):
+        return 'size={}/{}, hits={}, misses={}, evictions={}'.format(len(self), self.size, self.hits, self.misses, self.evictions)
+
+    
+class SampleHistory():
+    ''' fixed capacity history of (monotonic timestamp, raw value) pairs.
+        each sample is written twice, capacity apart, so any run of recent
+        samples is contiguous and is returned as a memoryview without copying.'''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = vector.zeros(2 * capacity)
+        self.values = vector.zeros(2 * capacity)
+
+        self.head = 0
+        self.count = 0
+
+        return
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+        return
+
+    def append(self, timestamp, value):
+        i = self.head
+        j = i + self.capacity
+
+        self.timestamps[i] = self.timestamps[j] = timestamp
+        self.values[i] = self.values[j] = value
+
+        i += 1
+        if i == self.capacity:
+            i = 0
+        self.head = i
+
+        if self.count < self.capacity:
+            self.count += 1
+
+        return
+
+    def latest(self, n=None):
+        ''' returns (timestamps, values) memoryviews of the last n samples, oldest first'''
+        if n is None or n > self.count:
+            n = self.count
+
+        stop = self.head + self.capacity
+        start = stop - n
+
+        return (memoryview(self.timestamps)[start:stop], memoryview(self.values)[start:stop])
+
+    def between(self, start_time, stop_time):
+        ''' returns (timestamps, values) memoryviews of samples taken from start_time to stop_time'''
+        timestamps, values = self.latest()
+
+        start = bisect.bisect_left(timestamps, start_time)
+        stop = bisect.bisect_right(timestamps, stop_time)
+
+        return (timestamps[start:stop], values[start:stop])
+
+    
 # lets move to a source/sink nomenclature
 class Stream():
     def __init__(self, type):
@@ -44,10 +169,163 @@ class Stream():
     def raw_units(self):
         ''' returns a string'''
         raise NotImplemented
+
+    # a Sampler overlaps conversions on streams that split update() into
+    # start() and finish(). streams that don't simply convert in start().
+
+    @property
+    def device(self):
+        ''' streams on the same device convert one at a time'''
+        return self
+
+    @property
+    def conversion_time(self):
+        ''' seconds from start() until finish() can collect a conversion'''
+        return 0.0
+
+    def start(self):
+        ''' begin a conversion'''
+        self.update()
+        return
+
+    def finish(self):
+        ''' collect a conversion begun by start()'''
+        return
+
+
+class AsyncStream():
+    ''' a Stream whose connect() and update() are awaitable'''
+    def __init__(self, type):
+        self.type = type
+
+        return
+
+    async def connect(self, address):
+        ''' initialize an input'''
+        raise NotImplementedError
+    
+    async def update(self):
+        ''' complete a conversion'''
+        raise NotImplementedError
+    
+    @property
+    def raw_value(self):
+        ''' returns a float'''
+        raise NotImplementedError
+
+    @property
+    def raw_units(self):
+        ''' returns a string'''
+        raise NotImplementedError
+
+
+class ExecutorStream(AsyncStream):
+    ''' adapts a blocking Stream to AsyncStream by running it in an executor.
+        streams sharing a device are updated one at a time.'''
+
+    # event loop -> device -> asyncio.Lock
+    locks = weakref.WeakKeyDictionary()
+
+    def __init__(self, stream, executor=None):
+        super().__init__(stream.type)
+
+        self.stream = stream
+        self.executor = executor # None for the loops default thread pool
+
+        return
+
+    def __getattr__(self, name):
+        # anything else, ie measured_quantity or validate_address(), is the streams
+        if name == 'stream':
+            raise AttributeError(name)
+
+        return getattr(self.stream, name)
+
+    @property
+    def lock(self):
+        devices = self.locks.setdefault(asyncio.get_running_loop(), dict())
+
+        return devices.setdefault(self.stream.device, asyncio.Lock())
+
+    async def connect(self, address):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.stream.connect, address)
+
+        return
+
+    async def update(self):
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            await loop.run_in_executor(self.executor, self.stream.update)
+
+        return
+
+    @property
+    def raw_value(self):
+        return self.stream.raw_value
+
+    @property
+    def raw_units(self):
+        return self.stream.raw_units
+
+
+async def gather(sensors):
+    ''' aupdate() many sensors concurrently'''
+    await asyncio.gather(*[sensor.aupdate() for sensor in sensors])
+
+    return
+
+
+class Sampler():
+    ''' updates a group of sensors, starting a conversion on every device at
+        once and waiting a single conversion time before collecting them.
+        a sweep takes about one conversion time per channel of the busiest device.'''
+    def __init__(self, sensors):
+        self.sensors = list(sensors)
+        self.rounds = self.plan(self.sensors)
+
+        return
+
+    def plan(self, sensors):
+        # one sensor per device in each round, in sensor order
+        devices = dict()
+        for sensor in sensors:
+            devices.setdefault(sensor.stream.device, []).append(sensor)
+
+        rounds = []
+        for queue in devices.values():
+            for i, sensor in enumerate(queue):
+                if i == len(rounds):
+                    rounds.append([])
+                rounds[i].append(sensor)
+
+        return rounds
+
+    def sweep(self):
+        ''' update every sensor once'''
+        for group in self.rounds:
+            ready_time = time.monotonic()
+            for sensor in group:
+                sensor.start()
+                ready_time = max(ready_time, time.monotonic() + sensor.stream.conversion_time)
+
+            pause_time = ready_time - time.monotonic()
+            if pause_time > 0:
+                time.sleep(pause_time)
+
+            for sensor in group:
+                sensor.finish()
+
+        return
     
     
 class Sensor():
+    # assigning any attribute written by pack() bumps revision
+    packed_attributes = frozenset(['id', 'kind', 'name', 'location', 'property', 'stream_type', 'address', 'calibration'])
+
     def __init__(self, sensor_id):
+        self.revision = 0
+
         self.id = sensor_id.strip().lower()
         
         # configured by procedure/deploy.prep()
@@ -61,6 +339,65 @@ class Sensor():
         self.location = ''
         self.address = 'ND'
 
+        self.cache = None # optional EvaluationCache
+        self.executor_stream = None # blocking stream adapted by aupdate()
+        self.history = None # optional SampleHistory
+
+        return
+
+    @classmethod
+    def restore(cls, fields):
+        ''' returns a sensor with fields, a dict of packed attributes read
+            back from a snapshot. they are loaded, not counted as edits,
+            and skip __setattr__(), which dominates a large load'''
+        blank = cls.__dict__.get('blank')
+        if blank is None:
+            blank = cls.blank = cls('').__dict__.copy()
+
+        sensor = cls.__new__(cls)
+        sensor.__dict__.update(blank)
+        sensor.__dict__.update(fields)
+        sensor.__dict__['revision'] = 0
+
+        return sensor
+
+    def __setattr__(self, name, value):
+        if name in self.packed_attributes:
+            self.__dict__['revision'] = self.__dict__.get('revision', 0) + 1
+
+        super().__setattr__(name, value)
+
+        return
+
+    @property
+    def fingerprint(self):
+        ''' changes whenever the packed sensor, calibration included, would change'''
+        if self.calibration is None:
+            return (self.revision, None)
+
+        return (self.revision, self.calibration.fingerprint)
+
+    def enable_cache(self, size=256, quantum=None):
+        ''' memoize evaluate() on the quantized raw value'''
+        self.cache = EvaluationCache(size, quantum)
+
+        return self.cache
+
+    def disable_cache(self):
+        self.cache = None
+
+        return
+
+    def enable_history(self, capacity):
+        ''' keep the last capacity raw values with their monotonic timestamps'''
+        self.history = SampleHistory(capacity)
+
+        return self.history
+
+    def record(self):
+        if self.history is not None:
+            self.history.append(time.monotonic(), self.stream.raw_value)
+
         return
 
     # @property
@@ -104,38 +441,73 @@ class Sensor():
     def unit_id(self):
         return self.calibration.unit_id
 
+    @property
+    def evaluator(self):
+        ''' a callable that scales a raw value with the present calibration'''
+        return self.calibration.compile()
+
     def evaluate(self, raw_value):
-        return self.calibration.equation.evaluate_y(raw_value)
+        if self.cache is not None:
+            return self.cache.evaluate(self.calibration.equation, raw_value)
+
+        return self.calibration.compile()(raw_value)
 
     def update(self):
         self.stream.update()
+        self.record()
+
+        return
+
+    async def aupdate(self):
+        ''' update() without blocking the event loop'''
+        stream = self.stream
+        if not isinstance(stream, AsyncStream):
+            if self.executor_stream is None or self.executor_stream.stream is not stream:
+                self.executor_stream = ExecutorStream(stream)
+            stream = self.executor_stream
+
+        await stream.update()
+        self.record()
+
+        return
+
+    def start(self):
+        self.stream.start()
+
+        return
+
+    def finish(self):
+        self.stream.finish()
+        self.record()
 
         return
     
     def pack(self, prefix):
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
         # sensor
-        package = ''
-        package += 'id = "{}"\n'.format(self.id)
-        package += 'kind = "{}"\n'.format(self.kind)
+        packer.entry(writer, 'id', self.id)
+        packer.entry(writer, 'kind', self.kind)
 
-        package += 'name = "{}"\n'.format(self.name)
-        package += 'location = "{}"\n'.format(self.location)
-        package += 'property = "{}"\n'.format(self.property)
+        packer.entry(writer, 'name', self.name)
+        packer.entry(writer, 'location', self.location)
+        packer.entry(writer, 'property', self.property)
 
-        package += 'stream_type = "{}"\n'.format(self.stream_type)
-        package += 'address = "{}"\n'.format(self.address)
+        packer.entry(writer, 'stream_type', self.stream_type)
+        packer.entry(writer, 'address', self.address)
         
         if self.calibration.is_valid:
             my_prefix = '{}.{}'.format(prefix, 'calibration')
-            package += '\n'
-            package += self.calibration.pack(my_prefix)
+            writer.write('\n')
+            self.calibration.pack_into(writer, my_prefix)
 
-        return package
+        return
 
     def unpack(self, package):
         # sensor
         self.id = package['id']
-        self.kind = package['kind']
+        self.kind = package.get('kind')
 
         self.name = package.get('name', '')
         self.location = package.get('location', '')
@@ -146,6 +518,9 @@ class Sensor():
 
         if 'calibration' in package:
             self.calibration = calibration.Calibration(package['calibration'])
+
+        if self.cache is not None:
+            self.cache.clear()
                 
         return
 
@@ -323,16 +698,16 @@ class Sensors(collections.UserDict):
         return
 
     def pack(self, prefix):
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
         # Sensors
-        package = ''
 
         for key, sensor in self.data.items():
-            sensor_prefix = '{}.{}'.format(prefix, key)
-            package += '\n'
-            package += '[{}]\n'.format(sensor_prefix)
-            package += sensor.pack(sensor_prefix)
+            sensor_prefix = '{}.{}'.format(prefix, packer.encode_key(key))
+            packer.section(writer, sensor, sensor_prefix, sensor.fingerprint, '\n[{}]\n'.format(sensor_prefix))
             
-        return package
+        return
 
     def unpack(self, package):
         for sensor_key, template in package.items():
@@ -527,9 +902,12 @@ class SensorsShell(shell.Shell):
         return
     
     def pack(self, prefix):
-        package = self.sensors.pack(prefix)
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
+        self.sensors.pack_into(writer, prefix)
         
-        return package
+        return
     
     def unpack(self, package):
         self.sensors.unpack(package)
@@ -16,9 +16,11 @@
 #
 
 import sys
+import math
 import time
 
 from . import shell
+from . import packer
 from . import statistics as rs
 from . import quantity
 
@@ -51,16 +53,18 @@ class Setpoint(shell.Shell):
         return self.target_quantity.name.lower()
     
     def pack(self, prefix):
+        return packer.pack(self, prefix)
+
+    def pack_into(self, writer, prefix):
         # Calibration SetPoint
 
-        package = ''
-        package += '[{}]\n'.format(prefix)        
-        package += 'type = "{}"\n'.format(self.type)
+        writer.write('[{}]\n'.format(prefix))
+        packer.entry(writer, 'type', self.type)
         
         my_prefix= '{}.{}'.format(prefix, 'target_quantity')
-        package += '{}'.format(self.target_quantity.pack(my_prefix))
+        self.target_quantity.pack_into(writer, my_prefix)
 
-        return package
+        return
 
     def unpack(self, package):
         # calibration setpoint
@@ -107,8 +111,30 @@ class StreamSetpoint(Setpoint):
         self.sample_period = 0.1
         self.update_period = 1
         self.number_of_samples = 50
+
+        # optional early termination. None takes number_of_samples,
+        # 'sem' stops when the standard error of the mean falls below threshold,
+        # 'drift' stops when successive window means differ by less than threshold.
+        self.convergence = None
+        self.threshold = 0.05 # mV
+        self.window = 10
+        self.min_samples = 10
+        self.max_samples = 500
         
+        # value stored as the measured quantity: 'mean', or a robust
+        # 'median', 'trimmed' mean or 'mad' outlier rejected mean.
+        self.estimator = 'mean'
+        self.robust = None
+
         self.stats = rs.RunningStats()
+        self.window_stats = rs.RunningStats()
+        self.window_mean = None
+
+        # filled in by run() in convergence mode, against number_of_samples.
+        #  negative when convergence took longer than the fixed count would.
+        self.samples_saved = 0
+        self.time_saved = 0.0
+        self.elapsed = 0.0 # seconds spent acquiring, by the monotonic clock
         
         return
 
@@ -128,20 +154,108 @@ class StreamSetpoint(Setpoint):
     def standard_deviation(self):
         return round(self.stats.standard_deviation(), 3)
 
+    @property
+    def sample_limit(self):
+        if self.convergence is None:
+            return self.number_of_samples
+
+        return self.max_samples
+
     def clone(self):
         scaled = self.target_quantity.clone()
         
         raw = None
         if self.measured_quantity:
             raw = self.measured_quantity.clone()
+
+        setpoint = StreamSetpoint(scaled, raw)
+        setpoint.sample_period = self.sample_period
+        setpoint.number_of_samples = self.number_of_samples
+        setpoint.convergence = self.convergence
+        setpoint.threshold = self.threshold
+        setpoint.window = self.window
+        setpoint.min_samples = self.min_samples
+        setpoint.max_samples = self.max_samples
+        setpoint.estimator = self.estimator
             
-        return(StreamSetpoint(scaled, raw))
+        return(setpoint)
 
     def dump(self):
         str = '{}: n={}, mean={}, var={}, sd={}'.format(self.target_quantity, self.n, self.mean, self.variance, self.standard_deviation)
 
         return str
 
+    def estimate(self):
+        ''' the measured value by the configured estimator'''
+        if self.robust is None:
+            return self.stats.mean()
+
+        return self.robust.value()
+
+    def converged(self, x):
+        ''' true once the samples pushed so far meet the convergence criteria'''
+        if self.convergence is None:
+            return False
+
+        if self.convergence == 'drift':
+            self.window_stats.push(x)
+            if self.window_stats.n < self.window:
+                return False
+
+            mean = self.window_stats.mean()
+            previous = self.window_mean
+            self.window_mean = mean
+            self.window_stats.clear()
+
+            return self.stats.n >= self.min_samples and previous is not None and abs(mean - previous) < self.threshold
+
+        if self.stats.n < self.min_samples:
+            return False
+
+        sem = self.stats.standard_deviation() / math.sqrt(self.stats.n)
+
+        return sem < self.threshold
+
+    @property
+    def convergence_synopsis(self):
+        return '{} convergence: n={} in {}s, saved {} samples, {}s against {} samples'.format(
+            self.convergence, self.n, round(self.elapsed, 1), self.samples_saved, round(self.time_saved, 1), self.number_of_samples)
+
+    def pack_into(self, writer, prefix):
+        super().pack_into(writer, prefix)
+
+        if self.convergence is not None:
+            writer.write('\n')
+            writer.write('[{}.{}]\n'.format(prefix, 'convergence'))
+            packer.entry(writer, 'mode', self.convergence)
+            packer.entry(writer, 'threshold', self.threshold)
+            packer.entry(writer, 'window', self.window)
+            packer.entry(writer, 'min_samples', self.min_samples)
+            packer.entry(writer, 'max_samples', self.max_samples)
+
+        if self.estimator != 'mean':
+            writer.write('\n')
+            writer.write('[{}.{}]\n'.format(prefix, 'estimator'))
+            packer.entry(writer, 'name', self.estimator)
+
+        return
+
+    def unpack(self, package):
+        super().unpack(package)
+
+        if 'convergence' in package:
+            section = package['convergence']
+            self.convergence = section['mode']
+            self.threshold = section.get('threshold', 0.05)
+            self.window = section.get('window', 10)
+            self.min_samples = section.get('min_samples', 10)
+            self.max_samples = section.get('max_samples', 500)
+
+        if 'estimator' in package:
+            self.estimator = package['estimator']['name']
+
+        return
+
     # evaluate?
     def run(self, sensor):
         # setpoint run
@@ -158,14 +272,24 @@ class StreamSetpoint(Setpoint):
         while True:
             print('   ({}): '.format(self.target_quantity), end='')
             self.stats.clear()
+            self.window_stats.clear()
+            self.window_mean = None
+            self.robust = rs.robust_estimator(self.estimator)
             
-            sample_time = time.time()
+            sample_time = time.monotonic()
             update_time = sample_time
-            for i in range(self.number_of_samples):
+            start_time = sample_time
+            for i in range(self.sample_limit):
                 sensor.update()
-                self.stats.push(sensor.stream.measured_quantity.value * 1000) #fix sensor
+                x = sensor.stream.measured_quantity.value * 1000 #fix sensor
+                self.stats.push(x)
+                if self.robust is not None:
+                    self.robust.push(x)
+
+                if self.converged(x):
+                    break
             
-                now = time.time()
+                now = time.monotonic()
                 if now > update_time:
                     print(round(sensor.raw_value, 3), end=', ')
                     sys.stdout.flush()
@@ -181,6 +305,15 @@ class StreamSetpoint(Setpoint):
 
             print()
             print('     {}'.format(self.stats.synopsis))
+            if self.robust is not None:
+                print('     {}: {}'.format(self.estimator, self.robust.synopsis))
+
+            self.elapsed = time.monotonic() - start_time
+            if self.convergence is not None:
+                # priced at the measured time per sample, which includes the sensor conversion
+                self.samples_saved = self.number_of_samples - self.n
+                self.time_saved = self.samples_saved * self.elapsed / max(self.n, 1)
+                print('     {}'.format(self.convergence_synopsis))
 
             prompt = '  {} Calibration Buffer. <space> to repeat, <enter> to advance'.format(self.target_quantity)
             print(prompt) #, end=''
@@ -188,7 +321,7 @@ class StreamSetpoint(Setpoint):
             key = self.get_char()
         
             if key != ' ':
-                self.measured_quantity.value = self.stats.mean()
+                self.measured_quantity.value = self.estimate()
                 break
             
         return True
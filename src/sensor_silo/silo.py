@@ -15,15 +15,25 @@
 # GNU Affero General Public License for more details.
 #
 
+import os
 import sys
+import json
+import shutil
 import datetime
+import tempfile
+import threading
+import collections
 
 import tomllib as tomli
 
 from . import shell
 from . import procedure
 from . import sensor
+from . import calibration
 from . import deploy
+from . import packer
+from . import snapshot
+from . import caltable
 
 class xDeploy():
     def __init__(self, streams, *kwargs):
@@ -95,11 +105,29 @@ class Deploy():
     def load(self, filename=None):
         config = ConfigFile()
         filename = config.get_filename(filename)
-        package = config.load(filename)
-        self.unpack(package)
+
+        loaded = config.load_snapshot(filename)
+        if loaded is None:
+            self.unpack(config.load(filename))
+            return
+
+        sensors, deployment = loaded
+        if sensors is not None:
+            self.sensors = sensors
+
+        if deployment is not None:
+            self.deployment.unpack(deployment)
 
         return
     
+    def export_calibrations(self, filename):
+        ''' write the deployed calibrations as a CalibrationTable for other processes to map'''
+        unsupported = caltable.CalibrationTable.export(self.sensors, filename)
+        for sensor_id in unsupported:
+            print(' {} has no flat calibration form. exported without coefficients.'.format(sensor_id))
+
+        return
+
     def connect(self, streams):
         for sensor in self.sensors.values():
             stream = streams[sensor.stream_type]() # create a new hardware stream instance
@@ -117,6 +145,341 @@ class Deploy():
         return
 
 
+class Sink():
+    ''' base class for a destination of interval results.
+        Runtime calls put(), specialized sinks implement write()'''
+    def put(self, timestamp, results):
+        self.write([(timestamp, results)])
+
+        return
+
+    def write(self, batch):
+        ''' deliver a list of (timestamp, results) or raise'''
+        raise NotImplementedError
+
+    def flush(self):
+        return
+
+    def close(self):
+        return
+
+
+class MemorySink(Sink):
+    ''' keeps every batch in memory. clear online to simulate an outage'''
+    def __init__(self):
+        self.batches = []
+        self.online = True
+
+        return
+
+    @property
+    def items(self):
+        return [item for batch in self.batches for item in batch]
+
+    def write(self, batch):
+        if not self.online:
+            raise ConnectionError('memory sink is offline')
+
+        self.batches.append(list(batch))
+
+        return
+
+
+class JsonlSink(Sink):
+    ''' appends one json object per result to a local file'''
+    def __init__(self, filename):
+        self.filename = filename
+
+        return
+
+    def write(self, batch):
+        with open(self.filename, 'a') as fp:
+            for timestamp, results in batch:
+                fp.write(json.dumps({'timestamp': timestamp, 'results': results}))
+                fp.write('\n')
+
+        return
+
+    def read(self):
+        ''' yields (timestamp, results) in file order, skipping torn lines'''
+        if not os.path.exists(self.filename):
+            return
+
+        with open(self.filename, 'r') as fp:
+            for line in fp:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                yield (item['timestamp'], item['results'])
+
+        return
+
+
+class QueuedSink(Sink):
+    ''' decouples producers from a slow sink. put() only queues, a background
+        worker delivers batches and retries failures. when the bounded queue
+        is full the overflow policy either drops the oldest result, blocks the
+        producer, or spills to a jsonl file that is replayed in order once
+        the sink catches up.'''
+
+    policies = ['drop_oldest', 'block', 'spill']
+
+    def __init__(self, sink, maxsize=1000, batch_size=100, overflow='drop_oldest', spill_filename=None, retry_delay=5.0):
+        if overflow not in self.policies:
+            raise ValueError('overflow policy must be one of {}'.format(self.policies))
+
+        if overflow == 'spill' and spill_filename is None:
+            raise ValueError('the spill policy needs a spill_filename')
+
+        self.sink = sink
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.retry_delay = retry_delay
+
+        self.spill = None
+        self.replay = None
+        self.backlog = 0 # results waiting in the spill file
+        self.replaying = False # the replay file is being delivered
+        if spill_filename is not None:
+            # anything left over from a previous run is delivered first
+            self.spill = JsonlSink(spill_filename)
+            self.replay = JsonlSink(spill_filename + '.replay')
+            self.replay_cursor = spill_filename + '.cursor' # byte offset acknowledged in the replay file
+            self.replaying = os.path.exists(self.replay.filename)
+            if os.path.exists(self.spill.filename):
+                self.backlog = 1
+
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.closed = False
+
+        self.delivered = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failures = 0
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+        return
+
+    @property
+    def synopsis(self):
+        return 'queued={}, delivered={}, dropped={}, spilled={}, failures={}'.format(
+            len(self.queue), self.delivered, self.dropped, self.spilled, self.failures)
+
+    def put(self, timestamp, results):
+        with self.condition:
+            if self.closed:
+                raise ValueError('put() on a closed sink')
+
+            if self.overflow == 'spill' and (self.backlog or len(self.queue) >= self.maxsize):
+                # once spilling, keep spilling until the worker catches up, preserving order
+                self.spill.put(timestamp, results)
+                self.spilled += 1
+                self.backlog += 1
+                self.condition.notify_all()
+                return
+
+            if self.overflow == 'block':
+                # a batch in flight still counts, it may be put back
+                while len(self.queue) + self.in_flight >= self.maxsize and not self.closed:
+                    self.condition.wait()
+
+                if self.closed:
+                    raise ValueError('put() on a closed sink')
+            elif len(self.queue) >= self.maxsize:
+                self.queue.popleft()
+                self.dropped += 1
+
+            self.queue.append((timestamp, results))
+            self.condition.notify_all()
+
+        return
+
+    def flush(self, timeout=None):
+        ''' wait until everything put so far has been delivered'''
+        with self.condition:
+            return self.condition.wait_for(lambda: not (self.queue or self.backlog or self.replaying or self.in_flight), timeout)
+
+    def close(self, timeout=None):
+        ''' stop accepting results, deliver what is queued and stop the worker'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.worker.join(timeout)
+        self.sink.close()
+
+        return
+
+    def deliver(self, batch):
+        try:
+            self.sink.write(batch)
+        except Exception:
+            self.failures += 1
+            return False
+
+        self.delivered += len(batch)
+
+        return True
+
+    def run(self):
+        while True:
+            batch = None
+            with self.condition:
+                while not (self.replaying or self.queue or self.backlog or self.closed):
+                    self.condition.wait()
+
+                if self.replaying:
+                    # spilled results are older than anything queued since
+                    self.in_flight = 1
+                elif self.queue:
+                    batch = [self.queue.popleft() for i in range(min(self.batch_size, len(self.queue)))]
+                    self.in_flight = len(batch)
+                    self.condition.notify_all()
+                elif self.backlog:
+                    # the queue is drained, take the spill file for replay
+                    if os.path.exists(self.spill.filename):
+                        self.save_cursor(None)
+                        os.replace(self.spill.filename, self.replay.filename)
+                        self.replaying = True
+                    self.backlog = 0
+                    continue
+                else:
+                    return # closed and drained
+
+            if batch is not None:
+                ok = self.deliver(batch)
+                if not ok:
+                    self.refill(batch)
+            else:
+                ok = self.replay_spill()
+                if ok:
+                    self.replaying = False
+
+            with self.condition:
+                self.in_flight = 0
+                self.condition.notify_all()
+                if not ok and not self.closed:
+                    self.condition.wait(self.retry_delay)
+
+            if not ok and self.closed:
+                # give up for this run. undelivered results go to the spill file
+                self.spill_queue()
+                return
+
+    def refill(self, batch):
+        ''' put an undelivered batch back at the head of the queue, within maxsize.
+            the block policy keeps room for it, drop_oldest drops from the batch
+            and spill moves the newest queued results to the spill file'''
+        with self.condition:
+            self.queue.extendleft(reversed(batch))
+
+            excess = len(self.queue) - self.maxsize
+            if excess > 0 and self.overflow == 'spill':
+                newest = [self.queue.pop() for i in range(excess)]
+                newest.reverse()
+                self.spill_front(newest)
+                self.backlog += excess
+            else:
+                for i in range(max(excess, 0)):
+                    self.queue.popleft()
+                    self.dropped += 1
+
+        return
+
+    def spill_queue(self):
+        ''' on a failed close, move what is still queued to the front of the
+            spill file, behind the replay file, so the next run delivers it in order'''
+        with self.condition:
+            batch = list(self.queue)
+            self.queue.clear()
+
+        if not batch:
+            return
+
+        if self.spill is None:
+            self.dropped += len(batch)
+            return
+
+        self.spill_front(batch)
+
+        return
+
+    def spill_front(self, batch):
+        ''' write batch ahead of anything already in the spill file'''
+        temporary = JsonlSink(self.spill.filename + '.tmp')
+        with open(temporary.filename, 'w'):
+            pass
+
+        temporary.write(batch)
+        if os.path.exists(self.spill.filename):
+            with open(self.spill.filename, 'rb') as source, open(temporary.filename, 'ab') as fp:
+                shutil.copyfileobj(source, fp)
+
+        os.replace(temporary.filename, self.spill.filename)
+        self.spilled += len(batch)
+
+        return
+
+    def read_cursor(self):
+        try:
+            with open(self.replay_cursor, 'r') as fp:
+                return int(fp.read())
+        except (OSError, ValueError):
+            return 0
+
+    def save_cursor(self, offset):
+        ''' record offset as delivered. None starts the next replay file from the top'''
+        if offset is None:
+            if os.path.exists(self.replay_cursor):
+                os.remove(self.replay_cursor)
+            return
+
+        with open(self.replay_cursor + '.tmp', 'w') as fp:
+            fp.write(str(offset))
+        os.replace(self.replay_cursor + '.tmp', self.replay_cursor)
+
+        return
+
+    def replay_spill(self):
+        ''' deliver the replay file from the cursor. the cursor moves past each
+            batch once the sink accepts it, so a failure resumes where it stopped'''
+        if not os.path.exists(self.replay.filename):
+            return True
+
+        offset = self.read_cursor()
+        end = offset
+        batch = []
+        with open(self.replay.filename, 'rb') as fp:
+            fp.seek(offset)
+            for line in fp:
+                end += len(line)
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue # torn by a power cut
+                batch.append((item['timestamp'], item['results']))
+
+                if len(batch) == self.batch_size:
+                    if not self.deliver(batch):
+                        return False
+                    self.save_cursor(end)
+                    batch = []
+
+        if batch and not self.deliver(batch):
+            return False
+
+        os.remove(self.replay.filename)
+        self.save_cursor(None)
+
+        return True
+
+    
 class ConfigFile():
     def __init__(self):
         self.suffix = '.toml'
@@ -127,26 +490,201 @@ class ConfigFile():
     def load(self, filename=None):
         if filename is None:
             filename = self.filename
-            
-        package = ''
+
         with open(filename, 'rb') as fp:
             package = tomli.load(fp)
-            print(' calibration data loaded from {}.'.format(filename))
+
+        print(' calibration data loaded from {}.'.format(filename))
+
+        # calibrations journaled since the file was saved
+        count = 0
+        sensors = package.setdefault('sensors', dict())
+        for sensor_key, section in self.read_journal(filename):
+            if sensor_key in sensors:
+                sensors[sensor_key]['calibration'] = section
+                count += 1
+            else:
+                print(' journal entry for unknown sensor {}. ignoring.'.format(sensor_key))
+
+        if count:
+            print(' {} journaled calibrations replayed.'.format(count))
 
         return package
 
-    def save(self, package, filename=None):
+    def load_snapshot(self, filename=None):
+        ''' returns (Sensors, deployment package) from the binary snapshot saved
+            with filename, journal replayed, or None if it is missing or stale'''
+        if filename is None:
+            filename = self.filename
+
+        loaded = snapshot.Snapshot.read(filename)
+        if loaded is None:
+            return None
+
+        print(' calibration data loaded from {}.'.format(snapshot.Snapshot.filename_for(filename)))
+
+        sensors = loaded[0]
+        count = 0
+        for sensor_key, section in self.read_journal(filename):
+            if sensors is not None and sensor_key in sensors:
+                sensors[sensor_key].calibration = calibration.Calibration(section)
+                count += 1
+            else:
+                print(' journal entry for unknown sensor {}. ignoring.'.format(sensor_key))
+
+        if count:
+            print(' {} journaled calibrations replayed.'.format(count))
+
+        return loaded
+
+    def save(self, package, filename=None, sensors=None, deployment=None):
+        ''' package is a string or anything with pack_into(writer), which is
+            streamed to a temporary file that then atomically replaces filename.
+            a power cut leaves either the old or the new file, never a mix.
+            sections unchanged since the last save of filename are copied from
+            it rather than packed, see packer.Splice.
+            sensors, a dict of Sensor, and deployment, a DeployShell, are also
+            written to a binary snapshot for Deploy to load, see load_snapshot()'''
         if filename is None:
             filename = self.filename
 
-        with open(filename, 'w') as fp:
-            fp.write(package)
-            print(' calibration data saved to {}.'.format(filename))
+        directory = os.path.dirname(os.path.abspath(filename))
+        try:
+            mode = os.stat(filename).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+
+        try:
+            previous = open(filename, 'rb')
+        except FileNotFoundError:
+            previous = None
+
+        fd, temporary = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(filename)), suffix='.tmp', dir=directory)
+        try:
+            fp = open(fd, 'wb')
+        except BaseException:
+            os.close(fd)
+            os.remove(temporary)
+            if previous is not None:
+                previous.close()
+            raise
+
+        try:
+            with fp:
+                writer = packer.Splice(fp, previous)
+                if isinstance(package, str):
+                    writer.write(package)
+                else:
+                    package.pack_into(writer)
+
+                writer.flush()
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            os.chmod(temporary, mode)
+            os.replace(temporary, filename)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        finally:
+            if previous is not None:
+                previous.close()
+
+        writer.commit(os.stat(filename))
+
+        self.sync_directory(directory)
+        print(' calibration data saved to {}.'.format(filename))
+
+        if sensors is not None or deployment is not None:
+            self.write_snapshot(sensors, deployment, (writer.position, writer.digest.digest()), filename)
+
+        # the new snapshot holds everything journaled against the old one
+        journal = self.journal_filename(filename)
+        if os.path.exists(journal):
+            os.remove(journal)
+            self.sync_directory(directory)
             
         self.filename = filename
 
         return
 
+    def write_snapshot(self, sensors, deployment, stamp, filename=None):
+        ''' write the binary snapshot of sensors and deployment, saved to filename with stamp'''
+        if filename is None:
+            filename = self.filename
+
+        try:
+            snapshot.Snapshot().write(sensors, deployment, stamp, snapshot.Snapshot.filename_for(filename))
+        except (OSError, ValueError) as error:
+            # a read only card or an exotic value, we will just parse the toml
+            print(' snapshot not written: {}'.format(error))
+
+        return
+
+    def sync_directory(self, directory):
+        # makes a rename or delete durable
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+        return
+
+    def journal_filename(self, filename=None):
+        if filename is None:
+            filename = self.filename
+
+        return filename + '.journal'
+
+    def journal(self, calibrations, filename=None):
+        ''' append a dict of sensor key to Calibration to the journal of filename.
+            load() replays it over the snapshot, save() folds it in'''
+        lines = []
+        for sensor_key, calibration in calibrations.items():
+            record = {'sensor': sensor_key, 'calibration': calibration.pack('calibration')}
+            lines.append(json.dumps(record) + '\n')
+
+        with open(self.journal_filename(filename), 'ab+') as fp:
+            # start on a fresh line after an entry torn by a power cut
+            if fp.seek(0, os.SEEK_END) > 0:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b'\n':
+                    lines.insert(0, '\n')
+
+            fp.write(''.join(lines).encode('utf-8'))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        return
+
+    def read_journal(self, filename=None):
+        ''' yields (sensor key, calibration section) in the order journaled'''
+        try:
+            fp = open(self.journal_filename(filename), 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+
+        with fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                    section = tomli.loads(record['calibration'])['calibration']
+                except (ValueError, KeyError):
+                    # torn by a power cut while appending, it was never acknowledged
+                    print(' skipping an incomplete journal entry.')
+                    continue
+
+                yield (record['sensor'], section)
+
+        return
+
     def get_filename(self, filename=None):
         new_name = filename
         if new_name is None:
@@ -177,6 +715,9 @@ class Shell(shell.Shell):
         self.sensors = sensor.SensorsShell(self.procedures)
         self.deploy = deploy.DeployShell()
 
+        self.filename = None # last loaded or saved
+        self.saved_calibrations = dict() # sensor key: (calibration, fingerprint) as last written
+
         self.prompt = '{}'.format(self.cyan(self.prompt))
 
         return
@@ -218,8 +759,9 @@ class Shell(shell.Shell):
         filename = config.get_filename()        
         print(' Saving sensor data to {}'.format(filename))
         
-        package = self.pack()
-        config.save(package, filename)
+        config.save(self, filename, self.sensors.sensors, self.deploy)
+        self.filename = filename
+        self.saved_calibrations = self.calibrations()
 
         return
 
@@ -233,8 +775,40 @@ class Shell(shell.Shell):
         package = config.load(filename)
 
         self.unpack(package)
+        self.filename = filename
+        self.saved_calibrations = self.calibrations()
         
         return
+
+    def do_journal(self, arg):
+        ''' append changed calibrations to the journal of the loaded file, without a full save'''
+        if self.filename is None:
+            print(' nothing loaded or saved yet. use save.')
+            return
+
+        present = self.calibrations()
+        changed = dict()
+        for key, state in present.items():
+            if self.saved_calibrations.get(key) != state:
+                changed[key] = state[0]
+
+        if not changed:
+            print(' no calibrations changed.')
+            return
+
+        ConfigFile().journal(changed, self.filename)
+        self.saved_calibrations = present
+        print(' {} calibrations journaled to {}.'.format(len(changed), ConfigFile().journal_filename(self.filename)))
+
+        return
+
+    def calibrations(self):
+        state = dict()
+        for key, s in self.sensors.sensors.items():
+            if s.calibration is not None:
+                state[key] = (s.calibration, s.calibration.fingerprint)
+
+        return state
     
     def do_exit(self, arg):
         ''' Done'''
@@ -243,18 +817,24 @@ class Shell(shell.Shell):
         return True
 
     def pack(self):
-        package = 'date = {}\n'.format(datetime.datetime.now())        
+        buffer = packer.Buffer()
+        self.pack_into(buffer)
+
+        return buffer.getvalue()
+
+    def pack_into(self, writer):
+        packer.entry(writer, 'date', datetime.datetime.now())
 
         prefix = 'procedures'
-        package += self.procedures.pack(prefix)
+        self.procedures.pack_into(writer, prefix)
         
         prefix = 'sensors'
-        package += self.sensors.pack(prefix)
+        self.sensors.pack_into(writer, prefix)
 
         prefix = 'deployment'
-        package += self.deploy.pack(prefix)
+        packer.section(writer, self.deploy, prefix, self.deploy.revision)
 
-        return package
+        return
 
     def unpack(self, package):
         print(package['date'])
@@ -0,0 +1,376 @@
+#
+# snapshot.py - a compact binary copy of a deployment file for fast startup.
+#               part of the python sensor silo project.
+#
+# Copyright (c) 2026 Coburn Wightman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+
+import os
+import array
+import struct
+import hashlib
+import datetime
+import tempfile
+import tomllib
+
+from . import sensor
+from . import calibration
+from . import factory
+from . import packer
+
+
+class Snapshot():
+    ''' the sensors and deployment of a deployment file in a flat, versioned
+        binary layout, written by ConfigFile.save() alongside the toml:
+
+          header       magic, version, size and sha256 of the toml, counts
+          strings      offsets, then one utf-8 blob
+          deployment   one fixed width record
+          sensors      fixed width records
+          calibrations fixed width records, equation parameters in numbers
+          numbers      float64 pool
+
+        read() builds Sensor, Calibration and equation objects straight from
+        the records. a snapshot whose stamp does not match the toml, byte for
+        byte, is ignored and the toml is parsed.'''
+
+    magic = b'SILOSNAP'
+    version = 2
+    suffix = '.snap'
+
+    # magic, version, flags, source size, source sha256, string count, sensor count, calibration count, number count
+    header = struct.Struct('<8sHHQ32sIIII')
+
+    # folder_name, group_name, key_name, integer mask, update_interval, over_sample_rate, filter_in_percent
+    deployment_record = struct.Struct('<IIIIddd')
+
+    # key, id, kind, name, location, property, stream_type, address, calibration
+    sensor_record = struct.Struct('<IIIIIIIII')
+
+    # procedure_type, scaled_units, unit_id, timestamp ordinal, interval days,
+    #  equation type, number start, number count, integer mask, packed equation
+    calibration_record = struct.Struct('<IIIiiIIIII')
+
+    absent = 0xffffffff
+
+    # header flags
+    HAS_SENSORS = 1
+    HAS_DEPLOYMENT = 2
+
+    deployment_strings = ('folder_name', 'group_name', 'key_name')
+    deployment_numbers = ('update_interval', 'over_sample_rate', 'filter_in_percent')
+
+    # equation parameters in record order. a sequence is stored as its
+    #  length then its values. other equations are stored packed, as toml.
+    layouts = {
+        'PolynomialEquation': ('degree', 'coefficients'),
+        'NtcBetaEquation': ('beta', 'r25'),
+        'PhorpNtcBetaEquation': ('beta', 'r25', 'bias_volts', 'bias_ohms'),
+        'SteinhartHartEquation': ('a', 'b', 'c'),
+        'PhorpSteinhartHartEquation': ('a', 'b', 'c', 'bias_volts', 'bias_ohms'),
+        'NtcTableEquation': ('ohms', 'celsius'),
+        'PhorpNtcTableEquation': ('ohms', 'celsius', 'bias_volts', 'bias_ohms'),
+    }
+    sequences = frozenset(['coefficients', 'ohms', 'celsius'])
+
+    def __init__(self):
+        self.strings = []
+        self.string_index = dict()
+        self.numbers = array.array('d')
+
+        return
+
+    @classmethod
+    def filename_for(cls, source):
+        return source + cls.suffix
+
+    @classmethod
+    def stamp(cls, source):
+        ''' returns (size, sha256) of the source file'''
+        digest = hashlib.sha256()
+        size = 0
+        with open(source, 'rb') as fp:
+            while True:
+                data = fp.read(1 << 20)
+                if not data:
+                    break
+
+                digest.update(data)
+                size += len(data)
+
+        return (size, digest.digest())
+
+    def intern(self, text):
+        if text is None:
+            return self.absent
+
+        index = self.string_index.get(text)
+        if index is None:
+            index = len(self.strings)
+            self.strings.append(text)
+            self.string_index[text] = index
+
+        return index
+
+    @staticmethod
+    def integers(name, values):
+        ''' returns True if values are all integers, which are checked to fit a float64'''
+        integers = all(type(value) is int for value in values)
+        if integers and any(int(float(value)) != value for value in values):
+            raise ValueError('integers in {} do not fit a snapshot'.format(name))
+
+        if not integers and not all(type(value) is float for value in values):
+            raise ValueError('{} is not all integer or all float'.format(name))
+
+        return integers and len(values) > 0
+
+    def add_numbers(self, name, values):
+        ''' returns True if values are all integers'''
+        integers = self.integers(name, values)
+        self.numbers.extend(float(value) for value in values)
+
+        return integers
+
+    def add_equation(self, equation):
+        ''' returns (type, number start, number count, integer mask, packed) of equation'''
+        start = len(self.numbers)
+        layout = self.layouts.get(equation.type)
+        if layout is None:
+            return (self.intern(equation.type), start, 0, 0, self.intern(packer.pack(equation, 'calibration')))
+
+        mask = 0
+        for bit, name in enumerate(layout):
+            value = getattr(equation, name)
+            if name in self.sequences:
+                value = list(value)
+                self.numbers.append(len(value))
+            else:
+                value = [value]
+
+            if self.add_numbers(name, value):
+                mask |= 1 << bit
+
+        return (self.intern(equation.type), start, len(self.numbers) - start, mask, self.absent)
+
+    def add_calibration(self, cal):
+        equation = (self.absent, 0, 0, 0, self.absent)
+        if cal.equation is not None:
+            equation = self.add_equation(cal.equation)
+
+        return self.calibration_record.pack(self.intern(cal.procedure_type), self.intern(cal.scaled_units),
+                                            self.intern(cal.unit_id), cal.timestamp.toordinal(), cal.interval.days,
+                                            *equation)
+
+    def write(self, sensors, deployment, stamp, filename):
+        ''' write sensors, a dict of Sensor, and deployment, a DeployShell, saved
+            to a toml with stamp. either may be None. raises ValueError if they
+            hold something we cannot encode.'''
+        size, digest = stamp
+
+        flags = 0
+        record = bytes(self.deployment_record.size)
+        if deployment is not None:
+            flags |= self.HAS_DEPLOYMENT
+            names = [self.intern(getattr(deployment, name)) for name in self.deployment_strings]
+            values = [getattr(deployment, name) for name in self.deployment_numbers]
+
+            mask = 0
+            for bit, (name, value) in enumerate(zip(self.deployment_numbers, values)):
+                if self.integers(name, [value]):
+                    mask |= 1 << bit
+
+            record = self.deployment_record.pack(*names, mask, *values)
+
+        records = bytearray()
+        calibrations = bytearray()
+        calibration_count = 0
+        if sensors is not None:
+            flags |= self.HAS_SENSORS
+            for key, s in sensors.items():
+                cal = self.absent
+                if s.calibration is not None:
+                    calibrations += self.add_calibration(s.calibration)
+                    cal = calibration_count
+                    calibration_count += 1
+
+                records += self.sensor_record.pack(self.intern(key), self.intern(s.id), self.intern(s.kind),
+                                                   self.intern(s.name), self.intern(s.location), self.intern(s.property),
+                                                   self.intern(s.stream_type), self.intern(s.address), cal)
+
+        encoded = [text.encode('utf-8') for text in self.strings]
+        offsets = array.array('I', [0])
+        for text in encoded:
+            offsets.append(offsets[-1] + len(text))
+
+        sensor_count = len(records) // self.sensor_record.size
+        header = self.header.pack(self.magic, self.version, flags, size, digest,
+                                  len(self.strings), sensor_count, calibration_count, len(self.numbers))
+
+        # the numbers are written first so they are 8 byte aligned
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, temporary = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(filename)), suffix='.tmp', dir=directory)
+        try:
+            with open(fd, 'wb') as fp:
+                fp.write(header)
+                fp.write(self.numbers.tobytes())
+                fp.write(record)
+                fp.write(records)
+                fp.write(calibrations)
+                fp.write(offsets.tobytes())
+                fp.write(b''.join(encoded))
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            # readable by every process on the gateway, like the toml
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, filename)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+        return
+
+    @classmethod
+    def read(cls, source, filename=None):
+        ''' returns (Sensors, deployment package) from the snapshot of source,
+            either None if it was not saved. returns None if there is no
+            snapshot of the present source, checked by size and sha256.'''
+        if filename is None:
+            filename = cls.filename_for(source)
+
+        try:
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+
+            if len(data) < cls.header.size:
+                return None
+
+            (magic, version, flags, size, digest, string_count, sensor_count,
+             calibration_count, number_count) = cls.header.unpack_from(data)
+
+            if magic != cls.magic or version != cls.version or os.stat(source).st_size != size:
+                return None
+
+            if cls.stamp(source) != (size, digest):
+                return None
+        except OSError:
+            return None
+
+        try:
+            return cls.decode(data, flags, string_count, sensor_count, calibration_count, number_count)
+        except (ValueError, IndexError, KeyError, struct.error, UnicodeDecodeError, tomllib.TOMLDecodeError):
+            return None
+
+    @classmethod
+    def decode(cls, data, flags, string_count, sensor_count, calibration_count, number_count):
+        offset = cls.header.size
+
+        numbers = array.array('d')
+        numbers.frombytes(data[offset:offset + 8 * number_count])
+        if len(numbers) != number_count:
+            raise ValueError('truncated snapshot')
+        offset += 8 * number_count
+
+        deployment_record = cls.deployment_record.unpack_from(data, offset)
+        offset += cls.deployment_record.size
+
+        end = offset + cls.sensor_record.size * sensor_count
+        sensor_records = cls.sensor_record.iter_unpack(data[offset:end])
+        offset = end
+
+        end = offset + cls.calibration_record.size * calibration_count
+        calibration_records = list(cls.calibration_record.iter_unpack(data[offset:end]))
+        offset = end
+
+        offsets = array.array('I')
+        offsets.frombytes(data[offset:offset + 4 * (string_count + 1)])
+        offset += 4 * (string_count + 1)
+
+        blob = data[offset:offset + offsets[-1]]
+        strings = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(string_count)]
+        strings.append(None) # absent
+
+        def text(index):
+            return strings[index if index != cls.absent else -1]
+
+        deployment = None
+        if flags & cls.HAS_DEPLOYMENT:
+            deployment = dict()
+            for name, index in zip(cls.deployment_strings, deployment_record[:3]):
+                deployment[name] = text(index)
+
+            mask = deployment_record[3]
+            for bit, (name, value) in enumerate(zip(cls.deployment_numbers, deployment_record[4:])):
+                deployment[name] = int(value) if mask & (1 << bit) else value
+
+        if not flags & cls.HAS_SENSORS:
+            return (None, deployment)
+
+        sensors = sensor.Sensors()
+        for key, sensor_id, kind, name, location, prop, stream_type, address, cal in sensor_records:
+            fields = {'id': text(sensor_id), 'kind': text(kind), 'name': text(name), 'location': text(location),
+                      'property': text(prop), 'stream_type': text(stream_type), 'address': text(address)}
+
+            if cal != cls.absent:
+                fields['calibration'] = cls.build_calibration(calibration_records[cal], text, numbers)
+
+            sensors.data[text(key)] = sensor.Sensor.restore(fields)
+
+        return (sensors, deployment)
+
+    @classmethod
+    def build_calibration(cls, record, text, numbers):
+        procedure_type, scaled_units, unit_id, timestamp, interval, kind, start, count, mask, packed = record
+
+        fields = {'procedure_type': text(procedure_type), 'scaled_units': text(scaled_units), 'unit_id': text(unit_id),
+                  'timestamp': datetime.date.fromordinal(timestamp), 'interval': datetime.timedelta(days=interval)}
+
+        if kind != cls.absent:
+            fields['equation'] = cls.build_equation(text(kind), start, count, mask, text(packed), numbers)
+
+        return calibration.Calibration.restore(fields)
+
+    @classmethod
+    def build_equation(cls, kind, start, count, mask, packed, numbers):
+        if packed is not None:
+            section = tomllib.loads(packed)['calibration']['equation']
+            return factory.EquationFactory().new(section)
+
+        equation = factory.EquationFactory.lookup(kind)()
+
+        values = dict()
+        i = start
+        for bit, name in enumerate(cls.layouts[kind]):
+            if name in cls.sequences:
+                size = int(numbers[i])
+                value = numbers[i + 1:i + 1 + size].tolist()
+                i += 1 + size
+            else:
+                value = numbers[i]
+                i += 1
+
+            if mask & (1 << bit):
+                value = [int(v) for v in value] if name in cls.sequences else int(value)
+
+            values[name] = value
+
+        if i != start + count:
+            raise ValueError('snapshot equation of {} numbers has {}'.format(count, i - start))
+
+        if 'ohms' in values:
+            equation.set_points(values.pop('ohms'), values.pop('celsius'))
+
+        for name, value in values.items():
+            setattr(equation, name, value)
+
+        return equation
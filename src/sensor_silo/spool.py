@@ -0,0 +1,358 @@
+#
+# spool.py - a disk backed store and forward spool for interval readings.
+#            part of the python sensor silo project.
+#
+# Copyright (c) 2026 Coburn Wightman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+
+import os
+import time
+import zlib
+import struct
+import threading
+
+from . import silo
+
+
+class Spool():
+    ''' an append only spool of (timestamp, sensor id, value) readings in
+        numbered segment files of fixed size records, each with a crc.
+        appends are fsync'd in batches. replay() delivers readings in order
+        from a persistent cursor and deletes segments once delivered.'''
+
+    # timestamp, sensor id, value, crc32 of the preceding fields
+    record = struct.Struct('<d32sdI')
+    body = struct.Struct('<d32sd')
+    id_size = 32 # utf-8 bytes. longer ids are refused, never truncated
+
+    # segment, offset of the next record to replay
+    cursor_record = struct.Struct('<QQ')
+
+    suffix = '.seg'
+
+    def __init__(self, directory, segment_size=256*1024, max_segments=64, sync_every=64, sync_interval=5.0):
+        self.directory = directory
+        self.records_per_segment = max(1, segment_size // self.record.size)
+        self.max_segments = max_segments # oldest undelivered segments are discarded beyond this
+        self.sync_every = sync_every # records
+        self.sync_interval = sync_interval # seconds
+
+        self.lock = threading.Lock()
+        self.fp = None
+        self.segment = 0
+        self.count = 0 # records in the open segment
+        self.unsynced = 0
+        self.synced_time = time.monotonic()
+
+        self.discarded = 0 # records lost to retention
+        self.corrupt = 0 # records that failed their crc
+
+        os.makedirs(directory, exist_ok=True)
+        self.cursor = self.load_cursor()
+        self.open_segment()
+
+        return
+
+    def segment_name(self, segment):
+        return os.path.join(self.directory, '{:08d}{}'.format(segment, self.suffix))
+
+    def segments(self):
+        ''' numbers of the segments on disk, oldest first'''
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix) and name[:-len(self.suffix)].isdigit():
+                found.append(int(name[:-len(self.suffix)]))
+
+        return sorted(found)
+
+    def open_segment(self):
+        segments = self.segments()
+        if segments:
+            self.segment = segments[-1]
+        else:
+            self.segment = max(self.cursor[0], 0)
+
+        filename = self.segment_name(self.segment)
+        self.fp = open(filename, 'ab')
+
+        # drop a record torn by a power cut
+        size = self.fp.seek(0, os.SEEK_END)
+        if size % self.record.size:
+            size -= size % self.record.size
+            self.fp.truncate(size)
+
+        self.count = size // self.record.size
+        if self.count >= self.records_per_segment:
+            self.rotate()
+
+        return
+
+    def rotate(self):
+        self.sync()
+        self.fp.close()
+
+        self.segment += 1
+        self.fp = open(self.segment_name(self.segment), 'ab')
+        self.count = 0
+
+        # retention bounds the disk, and card wear, during a long outage
+        segments = self.segments()
+        while len(segments) > self.max_segments:
+            oldest = segments.pop(0)
+            filename = self.segment_name(oldest)
+            self.discarded += os.path.getsize(filename) // self.record.size
+            os.remove(filename)
+            if self.cursor[0] <= oldest:
+                self.save_cursor((oldest + 1, 0))
+
+        return
+
+    def load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, 'cursor'), 'rb') as fp:
+                return self.cursor_record.unpack(fp.read(self.cursor_record.size))
+        except (OSError, struct.error):
+            segments = self.segments()
+            return (segments[0] if segments else 0, 0)
+
+    def save_cursor(self, cursor):
+        filename = os.path.join(self.directory, 'cursor')
+        with open(filename + '.tmp', 'wb') as fp:
+            fp.write(self.cursor_record.pack(*cursor))
+        os.replace(filename + '.tmp', filename)
+
+        self.cursor = cursor
+
+        return
+
+    def encode_id(self, sensor_id):
+        encoded = sensor_id.encode('utf-8')
+        if len(encoded) > self.id_size or encoded.endswith(b'\0'):
+            raise ValueError('sensor id {!r} does not fit a {} byte spool record'.format(sensor_id, self.id_size))
+
+        return encoded
+
+    def append(self, timestamp, results):
+        ''' spool one interval of results, a dict of sensor id to value.
+            raises ValueError, before writing any of them, if an id does not fit'''
+        encoded = [(self.encode_id(sensor_id), value) for sensor_id, value in results.items()]
+
+        with self.lock:
+            for sensor_id, value in encoded:
+                body = self.body.pack(timestamp, sensor_id, value)
+                self.fp.write(body)
+                self.fp.write(struct.pack('<I', zlib.crc32(body)))
+
+                self.count += 1
+                self.unsynced += 1
+                if self.count >= self.records_per_segment:
+                    self.rotate()
+
+            if self.unsynced >= self.sync_every or time.monotonic() - self.synced_time >= self.sync_interval:
+                self.sync()
+
+        return
+
+    def put(self, timestamp, results):
+        # lets a Runtime spool directly
+        self.append(timestamp, results)
+
+        return
+
+    def sync(self):
+        if self.unsynced:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+
+        self.unsynced = 0
+        self.synced_time = time.monotonic()
+
+        return
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.fp.close()
+
+        return
+
+    def read(self, max_records, cursor=None):
+        ''' returns ([(timestamp, sensor id, value)], next cursor) from cursor,
+            the replay cursor by default'''
+        with self.lock:
+            self.fp.flush()
+            segment, offset = self.cursor if cursor is None else cursor
+            last = self.segment
+
+        readings = []
+        while len(readings) < max_records and segment <= last:
+            wanted = (max_records - len(readings)) * self.record.size
+            try:
+                with open(self.segment_name(segment), 'rb') as fp:
+                    fp.seek(offset * self.record.size)
+                    data = fp.read(wanted)
+            except FileNotFoundError:
+                data = b''
+
+            whole = len(data) - len(data) % self.record.size
+            for timestamp, sensor_id, value, crc in self.record.iter_unpack(data[:whole]):
+                offset += 1
+                if zlib.crc32(self.body.pack(timestamp, sensor_id, value)) != crc:
+                    self.corrupt += 1
+                    continue
+
+                try:
+                    sensor_id = sensor_id.rstrip(b'\0').decode('utf-8')
+                except UnicodeDecodeError:
+                    # cut mid character by an older spool. skip it rather than stall replay
+                    self.corrupt += 1
+                    continue
+
+                readings.append((timestamp, sensor_id, value))
+
+            if whole < wanted:
+                # end of this segment. move on unless it is still being written
+                if segment == last:
+                    break
+                segment += 1
+                offset = 0
+
+        return (readings, (segment, offset))
+
+    @property
+    def pending(self):
+        ''' approximate number of records not yet replayed'''
+        with self.lock:
+            segment, offset = self.cursor
+            count = 0
+            for number in self.segments():
+                if number >= segment:
+                    count += os.path.getsize(self.segment_name(number)) // self.record.size
+            return count - offset
+
+    def replay(self, sink, max_records=512):
+        ''' deliver about max_records spooled readings to sink.write() in order.
+            a batch always ends on a whole interval, so it may run over
+            max_records by up to one interval. the cursor only advances once
+            the sink accepts them. returns the number of records delivered.'''
+        readings, cursor = self.read(max_records)
+        if not readings:
+            if cursor != self.cursor:
+                self.advance(cursor)
+            return 0
+
+        # finish the last interval, one timestamp never spans two batches.
+        #  append() writes an interval under the lock, so it is all there.
+        while True:
+            more, after = self.read(1, cursor)
+            if not more or more[0][0] != readings[-1][0]:
+                break
+            readings += more
+            cursor = after
+
+        # regroup the readings of each interval
+        batch = []
+        for timestamp, sensor_id, value in readings:
+            if not batch or batch[-1][0] != timestamp:
+                batch.append((timestamp, dict()))
+            batch[-1][1][sensor_id] = value
+
+        sink.write(batch)
+        self.advance(cursor)
+
+        return len(readings)
+
+    def advance(self, cursor):
+        with self.lock:
+            self.save_cursor(cursor)
+
+            # delete segments we are done with
+            for number in self.segments():
+                if number < cursor[0] and number != self.segment:
+                    os.remove(self.segment_name(number))
+
+        return
+
+
+class SpoolSink(silo.Sink):
+    ''' store and forward. every result is spooled to disk first, a background
+        worker forwards the spool to sink at no more than records_per_second
+        so a long backlog drains without starving live sampling.'''
+    def __init__(self, sink, spool, records_per_second=200, batch_size=128, retry_delay=10.0):
+        self.sink = sink
+        self.spool = spool
+        self.records_per_second = records_per_second
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+
+        self.forwarded = 0
+        self.failures = 0
+
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+        return
+
+    @property
+    def synopsis(self):
+        return 'pending={}, forwarded={}, failures={}, discarded={}, corrupt={}'.format(
+            self.spool.pending, self.forwarded, self.failures, self.spool.discarded, self.spool.corrupt)
+
+    def put(self, timestamp, results):
+        self.spool.append(timestamp, results)
+        self.wakeup.set()
+
+        return
+
+    def write(self, batch):
+        for timestamp, results in batch:
+            self.put(timestamp, results)
+
+        return
+
+    def flush(self):
+        with self.spool.lock:
+            self.spool.sync()
+
+        return
+
+    def close(self, timeout=None):
+        self.closed = True
+        self.wakeup.set()
+        self.worker.join(timeout)
+        self.spool.close()
+        self.sink.close()
+
+        return
+
+    def run(self):
+        while not self.closed:
+            try:
+                count = self.spool.replay(self.sink, self.batch_size)
+            except Exception:
+                self.failures += 1
+                self.wakeup.wait(self.retry_delay)
+                self.wakeup.clear()
+                continue
+
+            self.forwarded += count
+            if count:
+                # bounded replay throughput
+                time.sleep(count / self.records_per_second)
+            else:
+                self.wakeup.wait(1.0)
+                self.wakeup.clear()
+
+        return
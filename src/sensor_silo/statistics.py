@@ -1,9 +1,16 @@
 import math
+import bisect
+import struct
+import itertools
+
+from . import vector
 
 class RunningStats:
     # https://stackoverflow.com/a/17637351
     # ultimately from from https://github.com/liyanage/python-modules
 
+    __slots__ = ('n', 'old_m', 'new_m', 'old_s', 'new_s')
+
     def __init__(self):
         self.n = 0
         self.old_m = 0
@@ -11,8 +18,13 @@ class RunningStats:
         self.old_s = 0
         self.new_s = 0
 
+    # n, mean, M2 for to_bytes()
+    packing = struct.Struct('<qdd')
+
     def clear(self):
         self.n = 0
+        self.old_m = self.new_m = 0
+        self.old_s = self.new_s = 0
 
     def push(self, x):
         self.n += 1
@@ -27,6 +39,96 @@ class RunningStats:
             self.old_m = self.new_m
             self.old_s = self.new_s
 
+    def push_many(self, values, chunk_size=4096):
+        ''' push() an iterable or array. each chunk is reduced with a two pass
+            mean and M2 and then merged, so precision matches push()'''
+        data = vector.as_ndarray(values)
+        if data is not None:
+            data = data.ravel()
+            for start in range(0, len(data), chunk_size):
+                chunk = data[start:start + chunk_size]
+                mean = chunk.mean()
+                m2 = ((chunk - mean) ** 2).sum()
+                self.merge_state(len(chunk), float(mean), float(m2))
+
+            return self
+
+        fsum = math.fsum
+        values = iter(values)
+        while True:
+            chunk = list(itertools.islice(values, chunk_size))
+            if not chunk:
+                break
+
+            mean = fsum(chunk) / len(chunk)
+            m2 = fsum([(x - mean) * (x - mean) for x in chunk])
+            self.merge_state(len(chunk), mean, m2)
+
+        return self
+
+    def merge(self, other):
+        ''' fold another accumulator into this one (chan et al parallel variance)'''
+        return self.merge_state(*other.state)
+
+    def merge_state(self, n, mean, m2):
+        if n == 0:
+            return self
+
+        if self.n == 0:
+            self.n = n
+            self.old_m = self.new_m = mean
+            self.old_s = self.new_s = m2
+            return self
+
+        my_n, my_mean, my_m2 = self.state
+
+        total = my_n + n
+        delta = mean - my_mean
+
+        self.new_m = my_mean + delta * n / total
+        self.new_s = my_m2 + m2 + delta * delta * my_n * n / total
+        self.n = total
+
+        self.old_m = self.new_m
+        self.old_s = self.new_s
+
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __add__(self, other):
+        return RunningStats.from_state(self.state).merge(other)
+
+    @property
+    def state(self):
+        ''' (n, mean, M2), enough to rebuild or merge this accumulator'''
+        if self.n == 0:
+            return (0, 0.0, 0.0)
+
+        m2 = self.new_s if self.n > 1 else 0.0
+
+        return (self.n, self.new_m, m2)
+
+    @classmethod
+    def from_state(cls, state):
+        n, mean, m2 = state
+
+        stats = cls()
+        if n > 0:
+            stats.n = n
+            stats.old_m = stats.new_m = mean
+            stats.old_s = stats.new_s = m2
+
+        return stats
+
+    def to_bytes(self):
+        return self.packing.pack(*self.state)
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        return cls.from_state(cls.packing.unpack(buffer))
+
     def mean(self):
         return self.new_m if self.n else 0.0
 
@@ -40,6 +142,306 @@ class RunningStats:
     def synopsis(self):
         return 'n={}, mean={}, var={}, sd={}'.format(self.n, self.mean(), self.variance(), self.standard_deviation())
 
+
+
+class WindowStats:
+    ''' mean and variance of the last size samples, in a preallocated ring buffer'''
+
+    __slots__ = ('size', 'values', 'head', 'n', 'm', 's', 'pushes')
+
+    def __init__(self, size):
+        self.size = size
+        self.values = vector.zeros(size)
+        self.clear()
+
+    def clear(self):
+        self.head = 0
+        self.n = 0
+        self.m = 0.0
+        self.s = 0.0
+        self.pushes = 0
+
+    def push(self, x):
+        head = self.head
+
+        if self.n < self.size:
+            # filling, plain welford
+            self.n += 1
+            old_m = self.m
+            self.m = old_m + (x - old_m) / self.n
+            self.s += (x - old_m) * (x - self.m)
+        else:
+            # full, swap the oldest sample for x
+            old = self.values[head]
+            old_m = self.m
+            self.m = old_m + (x - old) / self.n
+            self.s += (x - old) * (x - self.m + old - old_m)
+
+        self.values[head] = x
+        head += 1
+        if head == self.size:
+            head = 0
+        self.head = head
+
+        # remove accumulated rounding once per lap, amortized O(1)
+        self.pushes += 1
+        if self.pushes == self.size:
+            self.pushes = 0
+            self.resync()
+
+    def resync(self):
+        if self.n == 0:
+            return
+
+        window = self.values[:self.n]
+        self.m = math.fsum(window) / self.n
+        self.s = math.fsum([(x - self.m) * (x - self.m) for x in window])
+
+    def mean(self):
+        return self.m if self.n else 0.0
+
+    def variance(self):
+        return max(self.s, 0.0) / (self.n - 1) if self.n > 1 else 0.0
+
+    def standard_deviation(self):
+        return math.sqrt(self.variance())
+
+    @property
+    def synopsis(self):
+        return 'n={}, mean={}, var={}, sd={}'.format(self.n, self.mean(), self.variance(), self.standard_deviation())
+
+
+class EwmaStats:
+    ''' exponentially weighted mean and variance. time_constant is in samples,
+        as in Deploy.time_constant, 1 is no filtering'''
+
+    __slots__ = ('alpha', 'n', 'm', 'v')
+
+    def __init__(self, time_constant):
+        if time_constant < 1:
+            time_constant = 1
+
+        self.alpha = 1.0 / time_constant
+        self.clear()
+
+    def clear(self):
+        self.n = 0
+        self.m = 0.0
+        self.v = 0.0
+
+    def push(self, x):
+        self.n += 1
+
+        if self.n == 1:
+            self.m = x
+            self.v = 0.0
+        else:
+            diff = x - self.m
+            increment = self.alpha * diff
+            self.m += increment
+            self.v = (1.0 - self.alpha) * (self.v + diff * increment)
+
+    def mean(self):
+        return self.m if self.n else 0.0
+
+    def variance(self):
+        return self.v
+
+    def standard_deviation(self):
+        return math.sqrt(self.variance())
+
+    @property
+    def synopsis(self):
+        return 'n={}, mean={}, var={}, sd={}'.format(self.n, self.mean(), self.variance(), self.standard_deviation())
+
+
+
+class P2Quantile:
+    ''' streaming p quantile estimate in constant memory.
+        the P-square algorithm of Jain and Chlamtac, 1985'''
+
+    __slots__ = ('p', 'n', 'heights', 'positions', 'desired', 'increments')
+
+    def __init__(self, p=0.5):
+        self.p = p
+        self.clear()
+
+    def clear(self):
+        p = self.p
+
+        self.n = 0
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2*p, 1 + 4*p, 3 + 2*p, 5]
+        self.increments = [0, p/2, p, (1 + p)/2, 1]
+
+    def push(self, x):
+        self.n += 1
+        q = self.heights
+
+        if self.n <= 5:
+            bisect.insort(q, x)
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(q, x) - 1
+
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+
+        desired = self.desired
+        for i in range(5):
+            desired[i] += self.increments[i]
+
+        # nudge the middle markers toward their desired positions
+        for i in range(1, 4):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i+1] - n[i] > 1) or (d <= -1 and n[i-1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+
+                height = q[i] + d / (n[i+1] - n[i-1]) * ((n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i]) +
+                                                         (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+                if not q[i-1] < height < q[i+1]:
+                    height = q[i] + d * (q[i+d] - q[i]) / (n[i+d] - n[i])
+
+                q[i] = height
+                n[i] += d
+
+    def value(self):
+        if self.n == 0:
+            return 0.0
+
+        if self.n <= 5:
+            # exact, interpolated between the closest ranks
+            rank = self.p * (self.n - 1)
+            lo = int(rank)
+            hi = min(lo + 1, self.n - 1)
+            return self.heights[lo] + (rank - lo) * (self.heights[hi] - self.heights[lo])
+
+        return self.heights[2]
+
+    @property
+    def synopsis(self):
+        return 'n={}, p{}={}'.format(self.n, round(self.p * 100), self.value())
+
+
+class TrimmedMean:
+    ''' approximate trimmed mean in constant memory. samples outside the
+        running proportion..1-proportion quantile estimates are not averaged'''
+
+    __slots__ = ('proportion', 'lower', 'upper', 'stats')
+
+    def __init__(self, proportion=0.1):
+        self.proportion = proportion
+        self.lower = P2Quantile(proportion)
+        self.upper = P2Quantile(1 - proportion)
+        self.stats = RunningStats()
+
+    @property
+    def n(self):
+        return self.lower.n
+
+    def clear(self):
+        self.lower.clear()
+        self.upper.clear()
+        self.stats.clear()
+
+    def push(self, x):
+        self.lower.push(x)
+        self.upper.push(x)
+
+        accepted = self.lower.value() <= x <= self.upper.value()
+        if accepted:
+            self.stats.push(x)
+
+        return accepted
+
+    def value(self):
+        if self.stats.n == 0:
+            return self.lower.value()
+
+        return self.stats.mean()
+
+    @property
+    def synopsis(self):
+        return 'n={}, trimmed mean={} over {}'.format(self.n, self.value(), self.stats.n)
+
+
+class MadFilter:
+    ''' mean of the samples within k scaled median absolute deviations of
+        the running median. both medians are P2Quantile estimates'''
+
+    __slots__ = ('k', 'min_samples', 'median', 'deviation', 'stats', 'rejected')
+
+    # mad of a normal distribution to its standard deviation
+    scale = 1.4826
+
+    def __init__(self, k=3.0, min_samples=10):
+        self.k = k
+        self.min_samples = min_samples
+        self.median = P2Quantile(0.5)
+        self.deviation = P2Quantile(0.5)
+        self.stats = RunningStats()
+        self.rejected = 0
+
+    @property
+    def n(self):
+        return self.median.n
+
+    def clear(self):
+        self.median.clear()
+        self.deviation.clear()
+        self.stats.clear()
+        self.rejected = 0
+
+    def mad(self):
+        return self.deviation.value()
+
+    def push(self, x):
+        median = self.median.value()
+        deviation = abs(x - median)
+
+        accepted = True
+        if self.n >= self.min_samples and deviation > self.k * self.scale * self.mad():
+            accepted = False
+            self.rejected += 1
+
+        self.median.push(x)
+        self.deviation.push(deviation)
+
+        if accepted:
+            self.stats.push(x)
+
+        return accepted
+
+    def value(self):
+        return self.stats.mean()
+
+    @property
+    def synopsis(self):
+        return 'n={}, mean={}, median={}, mad={}, rejected={}'.format(self.n, self.value(), self.median.value(), self.mad(), self.rejected)
+
+
+def robust_estimator(name):
+    ''' returns a new estimator by name, None for the plain mean'''
+    if name == 'median':
+        return P2Quantile(0.5)
+    elif name == 'trimmed':
+        return TrimmedMean(0.1)
+    elif name == 'mad':
+        return MadFilter(3.0)
+    elif name == 'mean':
+        return None
+
+    raise ValueError('unknown estimator "{}". known estimators are mean, median, trimmed and mad'.format(name))
+
     
 if __name__ == '__main__':
     rs = RunningStats()
@@ -21,6 +21,9 @@ import datetime
 from . import procedure
 from . import quantity
 from . import equation
+from . import factory
+from . import vector
+from . import packer
 
 
 class NtcBetaProcedure(procedure.ProcedureShell):
@@ -90,16 +93,16 @@ class NtcBetaProcedure(procedure.ProcedureShell):
         ok = True
         return ok
     
-    def pack(self, prefix):
-        package = super().pack(prefix)
+    def pack_into(self, writer, prefix):
+        super().pack_into(writer, prefix)
     
         my_prefix = '{}.{}'.format(prefix, 'parameters')
         for name, parameter in self.parameters.items():
-            parameter_prefix = '{}.{}'.format(my_prefix, name)
-            package += '\n'
-            package += parameter.pack(parameter_prefix)
+            parameter_prefix = '{}.{}'.format(my_prefix, packer.encode_key(name))
+            writer.write('\n')
+            parameter.pack_into(writer, parameter_prefix)
 
-        return package
+        return
 
     def unpack(self, package):
         super().unpack(package)
@@ -130,46 +133,224 @@ class PhorpNtcBetaProcedure(NtcBetaProcedure):
         return
         
     
-class NtcBetaEquation(equation.Equation):
+class NtcEquation(equation.Equation):
+    ''' base class for equations that convert ntc ohms to temperature.
+        the scalar conversions are closures compiled on first use, with the
+        coefficients bound as locals. they shadow the methods below on the
+        instance until invalidate() drops them. a bound method taken before
+        the first call still finds them.'''
+
+    compiled_names = ('to_kelvin', 'to_celcius', 'evaluate_y')
+
+    def __init__(self):
+        super().__init__()
+
+        self.t0 = 273.15 # freezing point of water in degrees Kelvin
+
+        return
+
+    @property
+    def t0(self):
+        return self._t0
+
+    @t0.setter
+    def t0(self, t0):
+        self._t0 = t0
+        self.changed()
+        return
+
+    def invalidate(self):
+        super().invalidate()
+
+        for name in self.compiled_names:
+            self.__dict__.pop(name, None)
+
+        return
+
+    def to_kelvin(self, ntc_ohms):
+        ''' ohms to kelvin, 0 when out of domain'''
+        to_kelvin = self.__dict__.get('to_kelvin')
+        if to_kelvin is None:
+            to_kelvin = self.__dict__['to_kelvin'] = self.compile_kelvin()
+
+        return to_kelvin(ntc_ohms)
+
+    @vector.rowwise
+    def to_kelvin_many(self, ntc_ohms):
+        ''' specialized to_kelvin() over a buffer'''
+        raise NotImplementedError
+
+    def compile_kelvin(self):
+        ''' specialized to_kelvin() with our constants bound as locals'''
+        raise NotImplementedError
+
+    def compile_celcius(self):
+        ''' to_celcius() with our constants bound as locals'''
+        to_kelvin = self.compile_kelvin()
+        t0 = self.t0
+
+        def to_celcius(ntc_ohms):
+            return to_kelvin(ntc_ohms) - t0
+
+        return to_celcius
+
+    def compile_y(self):
+        ''' evaluate_y() with our constants bound as locals'''
+        return self.compile_celcius()
+
+    def to_celcius(self, ntc_ohms):
+        to_celcius = self.__dict__.get('to_celcius')
+        if to_celcius is None:
+            to_celcius = self.__dict__['to_celcius'] = self.compile_celcius()
+
+        return to_celcius(ntc_ohms)
+
+    def to_fahrenheit(self, ntc_ohms):
+        celcius = self.to_celcius(ntc_ohms)
+        fahrenheit = 9.0/5.0 * celcius + 32
+
+        return fahrenheit
+
+    @vector.rowwise
+    def to_celcius_many(self, ntc_ohms):
+        ''' to_celcius() over a buffer'''
+        t0 = self.t0
+        kelvin = self.to_kelvin_many(ntc_ohms)
+
+        if vector.numpy is not None:
+            return kelvin - t0
+
+        return vector.new_array([k - t0 for k in kelvin])
+
+    @vector.rowwise
+    def to_fahrenheit_many(self, ntc_ohms):
+        ''' to_fahrenheit() over a buffer'''
+        celcius = self.to_celcius_many(ntc_ohms)
+
+        if vector.numpy is not None:
+            return 9.0/5.0 * celcius + 32
+
+        return vector.new_array([9.0/5.0 * c + 32 for c in celcius])
+
+    def evaluate_y(self, ntc_ohms):
+        evaluate_y = self.__dict__.get('evaluate_y')
+        if evaluate_y is None:
+            evaluate_y = self.__dict__['evaluate_y'] = self.compile_y()
+
+        return evaluate_y(ntc_ohms)
+
+    @vector.rowwise
+    def evaluate_y_many(self, ntc_ohms):
+        return self.to_celcius_many(ntc_ohms)
+
+    def compile(self):
+        if self.table_range is not None:
+            return super().compile()
+
+        return self.compile_y()
+
+    
+@factory.register
+class NtcBetaEquation(NtcEquation):
     def __init__(self, package=None):
         super().__init__()
 
         self.beta = 3499
         self.r25 = 9999
-        self.t0 = 273.15 # freezing point of water in degrees Kelvin
         
         if package:
             self.unpack(package)
 
         return
 
-    def to_kelvin(self, ntc_ohms):
+    @property
+    def beta(self):
+        return self._beta
+
+    @beta.setter
+    def beta(self, beta):
+        self._beta = beta
+        self.changed()
+        return
+
+    @property
+    def r25(self):
+        return self._r25
+
+    @r25.setter
+    def r25(self, r25):
+        self._r25 = r25
+        self.changed()
+        return
+
+    @vector.rowwise
+    def to_kelvin_many(self, ntc_ohms):
+        ''' to_kelvin() over a buffer. out of domain samples are 0 kelvin'''
         t25 = self.t0 + 25.0
-        try:
-            kelvin = 1.0 / ( 1.0/t25 + (1.0/self.beta) * math.log(ntc_ohms/self.r25) )
-        except ValueError:
-            kelvin = 0
+        r25 = self.r25
+        inv_t25 = 1.0/t25
+        inv_beta = 1.0/self.beta
+
+        ohms = vector.as_ndarray(ntc_ohms)
+        if ohms is not None:
+            np = vector.numpy
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                ratio = ohms/r25
+                kelvin = 1.0 / (inv_t25 + inv_beta * np.log(ratio))
+
+            valid = (ratio > 0) & np.isfinite(kelvin)
+            return np.where(valid, kelvin, 0.0)
+
+        log = math.log
+        kelvin = vector.zeros(len(ntc_ohms))
+        for i, ohms in enumerate(ntc_ohms):
+            try:
+                kelvin[i] = 1.0 / (inv_t25 + inv_beta * log(ohms/r25))
+            except (ValueError, ZeroDivisionError):
+                pass
 
         return kelvin
-    def to_celcius(self, ntc_ohms):
-        kelvin = self.to_kelvin(ntc_ohms)
-        celcius = kelvin - self.t0
 
-        return celcius
+    def compile_kelvin(self):
+        log = math.log
+        r25 = self.r25
+        inv_t25 = 1.0/(self.t0 + 25.0)
+        inv_beta = 1.0/self.beta
 
-    def to_fahrenheit(self, ntc_ohms):
-        celcius = self.to_celcius(ntc_ohms)
-        fahrenheit = 9.0/5.0 * celcius + 32
+        def to_kelvin(ntc_ohms):
+            try:
+                kelvin = 1.0 / (inv_t25 + inv_beta * log(ntc_ohms/r25))
+            except ValueError:
+                kelvin = 0
 
-        return fahrenheit
+            return kelvin
+
+        return to_kelvin
+
+    def compile_celcius(self):
+        log = math.log
+        r25 = self.r25
+        t0 = self.t0
+        inv_t25 = 1.0/(t0 + 25.0)
+        inv_beta = 1.0/self.beta
 
-    def pack(self, prefix):
-        package = super().pack(prefix)
+        def to_celcius(ntc_ohms):
+            try:
+                kelvin = 1.0 / (inv_t25 + inv_beta * log(ntc_ohms/r25))
+            except ValueError:
+                kelvin = 0
+
+            return kelvin - t0
+
+        return to_celcius
+
+    def pack_into(self, writer, prefix):
+        super().pack_into(writer, prefix)
         
-        package += 'beta = {}\n'.format(self.beta)
-        package += 'r25 = {}\n'.format(self.r25)
+        packer.entry(writer, 'beta', self.beta)
+        packer.entry(writer, 'r25', self.r25)
 
-        return package
+        return
 
     def unpack(self, package):
         super().unpack(package)
@@ -178,9 +359,319 @@ class NtcBetaEquation(equation.Equation):
         self.r25 = package['r25']
         
         return
-    
-class PhorpNtcBetaEquation(NtcBetaEquation):
-    # perhaps integrate with ntcbeta and evaluate a quantity with source units.
+
+
+@factory.register
+class SteinhartHartEquation(NtcEquation):
+    ''' 1/T = a + b*ln(R) + c*ln(R)**3'''
+    def __init__(self, package=None):
+        super().__init__()
+
+        # a typical 10k ohm ntc
+        self.a = 1.129148e-3
+        self.b = 2.34125e-4
+        self.c = 8.76741e-8
+
+        if package:
+            self.unpack(package)
+
+        return
+
+    @property
+    def a(self):
+        return self._a
+
+    @a.setter
+    def a(self, a):
+        self._a = a
+        self.changed()
+        return
+
+    @property
+    def b(self):
+        return self._b
+
+    @b.setter
+    def b(self, b):
+        self._b = b
+        self.changed()
+        return
+
+    @property
+    def c(self):
+        return self._c
+
+    @c.setter
+    def c(self, c):
+        self._c = c
+        self.changed()
+        return
+
+    def solve(self, points):
+        ''' set a, b and c from three (ohms, celsius) points'''
+        (r1, t1), (r2, t2), (r3, t3) = points
+
+        l1 = math.log(r1)
+        l2 = math.log(r2)
+        l3 = math.log(r3)
+        y1 = 1.0 / (t1 + self.t0)
+        y2 = 1.0 / (t2 + self.t0)
+        y3 = 1.0 / (t3 + self.t0)
+
+        g2 = (y2 - y1) / (l2 - l1)
+        g3 = (y3 - y1) / (l3 - l1)
+
+        c = (g3 - g2) / (l3 - l2) / (l1 + l2 + l3)
+        b = g2 - c * (l1*l1 + l1*l2 + l2*l2)
+        a = y1 - (b + l1*l1 * c) * l1
+
+        self.a = a
+        self.b = b
+        self.c = c
+
+        return
+
+    @vector.rowwise
+    def to_kelvin_many(self, ntc_ohms):
+        ''' to_kelvin() over a buffer. out of domain samples are 0 kelvin'''
+        a = self.a
+        b = self.b
+        c = self.c
+
+        ohms = vector.as_ndarray(ntc_ohms)
+        if ohms is not None:
+            np = vector.numpy
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                ln_r = np.log(ohms)
+                kelvin = 1.0 / (a + b * ln_r + c * ln_r * ln_r * ln_r)
+
+            valid = (ohms > 0) & np.isfinite(kelvin)
+            return np.where(valid, kelvin, 0.0)
+
+        to_kelvin = self.compile_kelvin()
+        return vector.new_array([to_kelvin(ohms) for ohms in ntc_ohms])
+
+    def compile_kelvin(self):
+        log = math.log
+        a = self.a
+        b = self.b
+        c = self.c
+
+        def to_kelvin(ntc_ohms):
+            try:
+                ln_r = log(ntc_ohms)
+                kelvin = 1.0 / (a + b * ln_r + c * ln_r * ln_r * ln_r)
+            except (ValueError, ZeroDivisionError):
+                kelvin = 0
+
+            return kelvin
+
+        return to_kelvin
+
+    def compile_celcius(self):
+        log = math.log
+        a = self.a
+        b = self.b
+        c = self.c
+        t0 = self.t0
+
+        def to_celcius(ntc_ohms):
+            try:
+                ln_r = log(ntc_ohms)
+                kelvin = 1.0 / (a + b * ln_r + c * ln_r * ln_r * ln_r)
+            except (ValueError, ZeroDivisionError):
+                kelvin = 0
+
+            return kelvin - t0
+
+        return to_celcius
+
+    def pack_into(self, writer, prefix):
+        super().pack_into(writer, prefix)
+
+        packer.entry(writer, 'a', self.a)
+        packer.entry(writer, 'b', self.b)
+        packer.entry(writer, 'c', self.c)
+
+        return
+
+    def unpack(self, package):
+        super().unpack(package)
+
+        self.a = package['a']
+        self.b = package['b']
+        self.c = package['c']
+
+        return
+
+
+@factory.register
+class NtcTableEquation(NtcEquation):
+    ''' a manufacturers resistance vs temperature table.
+        interpolated linearly in ln(R) against 1/T.
+
+        the scalar paths index a uniform grid over ln(R) directly, with no
+        bisect. the grid is the interpolated table sampled grid_size times
+        and interpolated linearly in kelvin, within grid_error of the table.
+        the index and the grid are built on first use. values beyond the
+        table extrapolate its end segments exactly.'''
+
+    grid_size = 1024 # cells
+    typical = None # (ohms, celsius) of the default table
+
+    def __init__(self, package=None):
+        super().__init__()
+
+        if NtcTableEquation.typical is None:
+            # a typical 10k ohm, 3435K part in 5 degree steps
+            celsius = tuple(range(-40, 130, 5))
+            ohms = tuple(10000 * math.exp(3435 * (1.0/(t + self.t0) - 1.0/(25 + self.t0))) for t in celsius)
+            NtcTableEquation.typical = (ohms, celsius)
+
+        self.set_points(*self.typical)
+
+        if package:
+            self.unpack(package)
+
+        return
+
+    @property
+    def ohms(self):
+        return self._ohms
+
+    @property
+    def celsius(self):
+        return self._celsius
+
+    @property
+    def index(self):
+        ''' the LookupTable of ln(ohms) to 1/kelvin'''
+        if self._index is None:
+            keys = [math.log(r) for r in self._ohms]
+            values = [1.0 / (t + self.t0) for t in self._celsius]
+            self._index = equation.LookupTable(keys, values)
+
+        return self._index
+
+    def set_points(self, ohms, celsius):
+        ''' replace the table with matching lists of ohms and celsius'''
+        if len(ohms) < 2 or len(ohms) != len(celsius):
+            raise ValueError('ntc table needs two or more ohms, celsius pairs')
+
+        self._ohms = tuple(ohms)
+        self._celsius = tuple(celsius)
+
+        self.changed()
+
+        return
+
+    def invalidate(self):
+        super().invalidate()
+
+        # both depend on t0 as well as the points
+        self._index = None
+        self._grid = None
+
+        return
+
+    def build_grid(self):
+        ''' sample the table onto grid_size uniform cells of ln(R)'''
+        index = self.index
+        first = index.keys[0]
+        width = (index.keys[-1] - first) / self.grid_size
+
+        keys = [first + i * width for i in range(self.grid_size)] + [index.keys[-1]]
+        kelvin = [1.0 / index(key) for key in keys]
+
+        slopes = [(k1 - k0) / (r1 - r0) for r0, r1, k0, k1 in zip(keys, keys[1:], kelvin, kelvin[1:])]
+        intercepts = [k0 - m * r0 for r0, k0, m in zip(keys, kelvin, slopes)]
+
+        self._grid = (first, 1.0 / width, tuple(intercepts), tuple(slopes))
+
+        return self._grid
+
+    @property
+    def grid_error(self):
+        ''' the largest difference in kelvin between the grid and the table.
+            the grid is exact at its points, so check between them and at the table breaks'''
+        first, scale, intercepts, slopes = self._grid or self.build_grid()
+        index = self.index
+        width = 1.0 / scale
+
+        error = 0.0
+        for key in [first + (c + 0.5) * width for c in range(self.grid_size)] + list(index.breaks):
+            c = min(int((key - first) * scale), self.grid_size - 1)
+            error = max(error, abs(intercepts[c] + slopes[c] * key - 1.0 / index(key)))
+
+        return error
+
+    @vector.rowwise
+    def to_kelvin_many(self, ntc_ohms):
+        ''' to_kelvin() over a buffer. out of domain samples are 0 kelvin'''
+        ohms = vector.as_ndarray(ntc_ohms)
+        if ohms is not None:
+            np = vector.numpy
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                kelvin = 1.0 / self.index.many(np.log(ohms))
+
+            valid = (ohms > 0) & np.isfinite(kelvin)
+            return np.where(valid, kelvin, 0.0)
+
+        to_kelvin = self.compile_kelvin()
+        return vector.new_array([to_kelvin(ohms) for ohms in ntc_ohms])
+
+    def compile_kelvin(self):
+        return self.compile_grid(0.0)
+
+    def compile_celcius(self):
+        return self.compile_grid(self.t0)
+
+    def compile_grid(self, offset):
+        ''' kelvin - offset through the grid, with everything bound as locals'''
+        log = math.log
+        index = self.index
+        cells = self.grid_size
+        first, scale, intercepts, slopes = self._grid or self.build_grid()
+        intercepts = tuple(b - offset for b in intercepts)
+
+        def evaluate(ntc_ohms):
+            try:
+                ln_r = log(ntc_ohms)
+            except ValueError:
+                return 0.0 - offset
+
+            if ln_r >= first:
+                c = int((ln_r - first) * scale)
+                if c < cells:
+                    return intercepts[c] + slopes[c] * ln_r
+
+            # beyond the table
+            try:
+                return 1.0 / index(ln_r) - offset
+            except ZeroDivisionError:
+                return 0.0 - offset
+
+        return evaluate
+
+    def pack_into(self, writer, prefix):
+        super().pack_into(writer, prefix)
+
+        packer.entry(writer, 'ohms', self.ohms)
+        packer.entry(writer, 'celsius', self.celsius)
+
+        return
+
+    def unpack(self, package):
+        super().unpack(package)
+
+        self.set_points(package['ohms'], package['celsius'])
+
+        return
+
+
+class PhorpNtcEquation():
+    ''' the phorp bias divider ahead of an ntc equation.
+        mix in before the ntc equation, see PhorpNtcBetaEquation'''
     def __init__(self, package=None):
         super().__init__()
 
@@ -192,24 +683,85 @@ class PhorpNtcBetaEquation(NtcBetaEquation):
         
         return
 
-    def evaluate_y(self, ntc_millivolts):  # target_units
+    @property
+    def bias_volts(self):
+        return self._bias_volts
+
+    @bias_volts.setter
+    def bias_volts(self, bias_volts):
+        self._bias_volts = bias_volts
+        self.changed()
+        return
+
+    @property
+    def bias_ohms(self):
+        return self._bias_ohms
+
+    @bias_ohms.setter
+    def bias_ohms(self, bias_ohms):
+        self._bias_ohms = bias_ohms
+        self.changed()
+        return
+
+    def to_ohms(self, ntc_millivolts):
         ntc_volts = ntc_millivolts / 1000  # xx convert back to volts...
         
         ntc_amps = (self.bias_volts - ntc_volts) / self.bias_ohms
         ntc_ohms = ntc_volts / ntc_amps
 
-        #if 'c' in self.scaled_units.lower(): # xx
-        return self.to_celcius(ntc_ohms)
-
-        #return self.to_fahrenheit(ntc_ohms)
+        return ntc_ohms
 
-    def pack(self, prefix):
-        package = super().pack(prefix)
+    def compile_y(self):  # target_units
+        #if 'c' in self.scaled_units.lower(): # xx
+        to_kelvin = self.compile_kelvin()
+        bias_volts = self.bias_volts
+        bias_ohms = self.bias_ohms
+        t0 = self.t0
+
+        def evaluate_y(ntc_millivolts):
+            ntc_volts = ntc_millivolts / 1000
+            ntc_amps = (bias_volts - ntc_volts) / bias_ohms
+
+            return to_kelvin(ntc_volts / ntc_amps) - t0
+
+        return evaluate_y
+
+    @vector.rowwise
+    def to_ohms_many(self, ntc_millivolts):
+        ''' apply the bias divider to a buffer of millivolts'''
+        bias_volts = self.bias_volts
+        bias_ohms = self.bias_ohms
+
+        millivolts = vector.as_ndarray(ntc_millivolts)
+        if millivolts is not None:
+            ntc_volts = millivolts / 1000
+            ntc_amps = (bias_volts - ntc_volts) / bias_ohms
+            with vector.numpy.errstate(divide='ignore', invalid='ignore'):
+                return ntc_volts / ntc_amps
+
+        ntc_ohms = vector.zeros(len(ntc_millivolts))
+        for i, millivolts in enumerate(ntc_millivolts):
+            ntc_volts = millivolts / 1000
+            ntc_amps = (bias_volts - ntc_volts) / bias_ohms
+            try:
+                ntc_ohms[i] = ntc_volts / ntc_amps
+            except ZeroDivisionError:
+                ntc_ohms[i] = -1.0 # out of domain, masked by to_kelvin_many()
+
+        return ntc_ohms
+
+    @vector.rowwise
+    def evaluate_y_many(self, ntc_millivolts):
+        ''' evaluate_y() over a sequence, array.array or ndarray of millivolts'''
+        return self.to_celcius_many(self.to_ohms_many(ntc_millivolts))
+
+    def pack_into(self, writer, prefix):
+        super().pack_into(writer, prefix)
         
-        package += 'bias_volts = {}\n'.format(self.bias_volts)
-        package += 'bias_ohms = {}\n'.format(self.bias_ohms)
+        packer.entry(writer, 'bias_volts', self.bias_volts)
+        packer.entry(writer, 'bias_ohms', self.bias_ohms)
 
-        return package
+        return
 
     def unpack(self, package):
         super().unpack(package)
@@ -218,3 +770,40 @@ class PhorpNtcBetaEquation(NtcBetaEquation):
         self.bias_ohms = package.get('bias_ohms', 10000)
         
         return
+
+    
+@factory.register
+class PhorpNtcBetaEquation(PhorpNtcEquation, NtcBetaEquation):
+    # perhaps integrate with ntcbeta and evaluate a quantity with source units.
+
+    def compile_y(self):
+        log = math.log
+        bias_volts = self.bias_volts
+        bias_ohms = self.bias_ohms
+        r25 = self.r25
+        t0 = self.t0
+        inv_t25 = 1.0/(self.t0 + 25.0)
+        inv_beta = 1.0/self.beta
+
+        def evaluate_y(ntc_millivolts):
+            ntc_volts = ntc_millivolts / 1000
+            ntc_amps = (bias_volts - ntc_volts) / bias_ohms
+            ntc_ohms = ntc_volts / ntc_amps
+            try:
+                kelvin = 1.0 / (inv_t25 + inv_beta * log(ntc_ohms/r25))
+            except ValueError:
+                kelvin = 0
+
+            return kelvin - t0
+
+        return evaluate_y
+
+
+@factory.register
+class PhorpSteinhartHartEquation(PhorpNtcEquation, SteinhartHartEquation):
+    pass
+
+
+@factory.register
+class PhorpNtcTableEquation(PhorpNtcEquation, NtcTableEquation):
+    pass
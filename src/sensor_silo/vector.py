@@ -0,0 +1,72 @@
+#
+# vector.py - helpers to evaluate equations over buffers of samples.
+#             part of the python sensor silo project.
+#
+# Copyright (c) 2026 Coburn Wightman
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+
+import array
+import functools
+
+try:
+    import numpy
+except ImportError:
+    # numpy is optional. without it buffers are evaluated in a plain loop.
+    numpy = None
+
+
+def as_ndarray(values):
+    ''' returns values as a float ndarray, or None if numpy is not available'''
+    if numpy is None:
+        return None
+
+    return numpy.asarray(values, dtype=float)
+
+def new_array(results):
+    ''' returns an iterable of floats as a flat array.array'''
+    return array.array('d', results)
+
+def zeros(count):
+    ''' returns a preallocated array.array of count zeros'''
+    return array.array('d', bytes(8 * count))
+
+def is_nested(values):
+    ''' true if values is a sequence of sequences, rows of a 2d buffer'''
+    if isinstance(values, memoryview):
+        return values.ndim > 1
+
+    if isinstance(values, (array.array, str, bytes)) or not hasattr(values, '__getitem__'):
+        return False
+
+    try:
+        first = values[0]
+    except (IndexError, KeyError, TypeError):
+        return False
+
+    return hasattr(first, '__len__')
+
+def rowwise(method):
+    ''' decorates a *_many(self, values) method. numpy keeps the shape of
+        values by itself. without it, nested values are evaluated row by
+        row and returned as a list of rows, so the result is shaped like
+        values rather than flat'''
+    @functools.wraps(method)
+    def evaluate(self, values):
+        if numpy is None and is_nested(values):
+            if isinstance(values, memoryview):
+                values = values.tolist()
+            return [evaluate(self, row) for row in values]
+
+        return method(self, values)
+
+    return evaluate